@@ -1,77 +1,272 @@
+import argparse
 import asyncio
+import gzip
+import json
+import os
+import re
+import time
+from datetime import datetime
 import asyncpg
-from config import DATABASE_URL
+from config import DATABASE_URL, STATS_CACHE_TTL
+from segments import Segment
 
 
 class AdminPanel:
-    def __init__(self):
+    def __init__(self, stats_ttl=STATS_CACHE_TTL):
         self.pool = None
+        # Statistics are read from rollup tables; this only saves the round trip
+        # when the menu is opened repeatedly. Entries: key -> (expires_at, value)
+        self.stats_ttl = stats_ttl
+        self._stats_cache = {}
 
     async def create_pool(self):
         self.pool = await asyncpg.create_pool(DATABASE_URL)
 
+    async def _cached(self, key, load):
+        entry = self._stats_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        value = await load()
+        self._stats_cache[key] = (time.monotonic() + self.stats_ttl, value)
+        return value
+
+    def invalidate_statistics(self, *keys):
+        """Drop cached statistics (all of them if no keys are given)"""
+        if not keys:
+            self._stats_cache.clear()
+        for key in keys:
+            self._stats_cache.pop(key, None)
+
     async def get_all_users(self):
         """Get all users with their statistics"""
         async with self.pool.acquire() as conn:
             return await conn.fetch('''
                 SELECT 
-                    u.telegram_id,
-                    u.full_name,
-                    u.phone,
-                    u.age,
-                    u.region,
-                    u.language,
-                    u.referral_count,
-                    u.payment_status,
-                    u.created_at,
-                    COUNT(p.id) as payment_attempts
-                FROM users u
-                LEFT JOIN payments p ON u.telegram_id = p.user_id
-                GROUP BY u.telegram_id, u.full_name, u.phone, u.age, u.region, 
-                         u.language, u.referral_count, u.payment_status, u.created_at
-                ORDER BY u.created_at DESC
+                    telegram_id,
+                    full_name,
+                    phone,
+                    age,
+                    region,
+                    language,
+                    referral_count,
+                    payment_status,
+                    created_at,
+                    payment_attempts
+                FROM users
+                ORDER BY created_at DESC
             ''')
 
+    USER_COLUMNS = '''
+        telegram_id, full_name, phone, age, region, language,
+        referral_count, payment_status, created_at, payment_attempts
+    '''
+
+    async def list_users(self, limit=20, after=None):
+        """Get one page of users, newest first.
+
+        `after` is the (created_at, telegram_id) of the last row of the previous
+        page, so every page is an index range scan however deep it is.
+        """
+        async with self.pool.acquire() as conn:
+            if after is None:
+                return await conn.fetch(f'''
+                    SELECT {self.USER_COLUMNS} FROM users
+                    ORDER BY created_at DESC, telegram_id DESC
+                    LIMIT $1
+                ''', limit)
+            return await conn.fetch(f'''
+                SELECT {self.USER_COLUMNS} FROM users
+                WHERE (created_at, telegram_id) < ($2, $3)
+                ORDER BY created_at DESC, telegram_id DESC
+                LIMIT $1
+            ''', limit, *after)
+
+    @staticmethod
+    def _contains(text):
+        """ILIKE pattern matching `text` anywhere, with LIKE wildcards escaped"""
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return f"%{escaped}%"
+
+    async def search_users(self, query, limit=20):
+        """Find users by a fuzzy name or a phone fragment, best matches first.
+
+        Phones are compared digits only, so "90 123" finds "+998 90 123-45-67".
+        """
+        query = query.strip()
+        if not query:
+            return []
+        args = [query, self._contains(query), limit]
+        conditions = ["full_name % $1", "full_name ILIKE $2"]
+        digits = re.sub(r'\D', '', query)
+        if digits:
+            args.append(self._contains(digits))
+            # Same expression as idx_users_phone_digits_trgm
+            conditions.append(f"regexp_replace(phone, '\\D', '', 'g') ILIKE ${len(args)}")
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(f'''
+                SELECT {self.USER_COLUMNS},
+                       GREATEST(similarity(full_name, $1), similarity(phone, $1)) as score
+                FROM users
+                WHERE {' OR '.join(conditions)}
+                ORDER BY score DESC, created_at DESC
+                LIMIT $3
+            ''', *args)
+
     async def get_payment_statistics(self):
         """Get payment statistics"""
-        async with self.pool.acquire() as conn:
-            stats = await conn.fetchrow('''
-                SELECT 
-                    COUNT(*) as total_payments,
-                    COUNT(CASE WHEN status = 'approved' THEN 1 END) as approved_payments,
-                    COUNT(CASE WHEN status = 'rejected' THEN 1 END) as rejected_payments,
-                    COUNT(CASE WHEN status = 'pending' THEN 1 END) as pending_payments
-                FROM payments
-            ''')
-            return stats
+        async def load():
+            async with self.pool.acquire() as conn:
+                return await conn.fetchrow('''
+                    SELECT 
+                        COALESCE(SUM(total), 0) as total_payments,
+                        COALESCE(SUM(total) FILTER (WHERE status = 'approved'), 0) as approved_payments,
+                        COALESCE(SUM(total) FILTER (WHERE status = 'rejected'), 0) as rejected_payments,
+                        COALESCE(SUM(total) FILTER (WHERE status = 'pending'), 0) as pending_payments
+                    FROM payment_status_counts
+                ''')
+        return await self._cached('payments', load)
+
+    async def get_signup_statistics(self, days=7):
+        """Get signups per day for the last `days` days, newest first"""
+        async def load():
+            async with self.pool.acquire() as conn:
+                return await conn.fetch('''
+                    SELECT day, signups
+                    FROM signup_daily
+                    WHERE day > CURRENT_DATE - $1::int
+                    ORDER BY day DESC
+                ''', days)
+        return await self._cached(('signups', days), load)
 
     async def get_referral_statistics(self):
         """Get referral statistics"""
+        async def load():
+            async with self.pool.acquire() as conn:
+                return await conn.fetch('''
+                    SELECT 
+                        telegram_id,
+                        full_name,
+                        referral_count,
+                        referral_count as actual_referrals,
+                        paid_referral_count as paid_referrals
+                    FROM users
+                    WHERE referral_count > 0
+                    ORDER BY referral_count DESC
+                ''')
+        return await self._cached('referrals', load)
+
+    async def repair_referral_counters(self):
+        """Recompute referral_count and paid_referral_count in bulk; returns the number of corrected rows"""
         async with self.pool.acquire() as conn:
-            return await conn.fetch('''
-                SELECT 
-                    u.telegram_id,
-                    u.full_name,
-                    u.referral_count,
-                    COUNT(r.telegram_id) as actual_referrals,
-                    COUNT(CASE WHEN r.payment_status = TRUE THEN 1 END) as paid_referrals
-                FROM users u
-                LEFT JOIN users r ON u.telegram_id = r.referrer_id
-                WHERE u.referral_count > 0
-                GROUP BY u.telegram_id, u.full_name, u.referral_count
-                ORDER BY u.referral_count DESC
+            result = await conn.execute('''
+                UPDATE users u
+                SET referral_count = COALESCE(r.total, 0),
+                    paid_referral_count = COALESCE(r.paid, 0)
+                FROM users t
+                LEFT JOIN (
+                    SELECT
+                        referrer_id,
+                        COUNT(*) AS total,
+                        COUNT(*) FILTER (WHERE payment_status = TRUE) AS paid
+                    FROM users
+                    WHERE referrer_id IS NOT NULL AND referrer_id <> telegram_id
+                    GROUP BY referrer_id
+                ) r ON r.referrer_id = t.telegram_id
+                WHERE u.telegram_id = t.telegram_id
+                  AND (u.referral_count IS DISTINCT FROM COALESCE(r.total, 0)
+                       OR u.paid_referral_count IS DISTINCT FROM COALESCE(r.paid, 0))
             ''')
+        self.invalidate_statistics('referrals')
+        return int(result.split()[-1])
 
-    async def export_users_csv(self):
-        """Export users to CSV format"""
-        users = await self.get_all_users()
+    EXPORT_QUERIES = {
+        'users': '''
+            SELECT
+                u.telegram_id,
+                u.full_name,
+                u.phone,
+                u.age,
+                u.region,
+                u.language,
+                u.referral_count,
+                u.payment_status,
+                u.created_at,
+                u.payment_attempts
+            FROM users u
+            ORDER BY u.created_at DESC
+        ''',
+        'payments': '''
+            SELECT id, user_id, screenshot_file_id, status, admin_message_id, created_at
+            FROM payments
+            ORDER BY id
+        ''',
+        'questions': '''
+            SELECT id, user_id, question, answered, created_at
+            FROM questions
+            ORDER BY id
+        ''',
+    }
 
-        csv_content = "telegram_id,full_name,phone,age,region,language,referral_count,payment_status,created_at,payment_attempts\n"
+    async def export_csv(self, table, path):
+        """Stream a table to a CSV file with COPY; a `.gz` path is gzip-compressed.
 
-        for user in users:
-            csv_content += f"{user['telegram_id']},{user['full_name']},{user['phone']},{user['age']},{user['region']},{user['language']},{user['referral_count']},{user['payment_status']},{user['created_at']},{user['payment_attempts']}\n"
+        Returns (row_count, elapsed_seconds).
+        """
+        if table not in self.EXPORT_QUERIES:
+            raise ValueError(f"Unknown export {table!r}, expected one of {', '.join(self.EXPORT_QUERIES)}")
 
-        return csv_content
+        started_at = time.monotonic()
+        opener = gzip.open if str(path).endswith('.gz') else open
+        with opener(path, 'wb') as f:
+            async def write(chunk):
+                f.write(chunk)
+
+            async with self.pool.acquire() as conn:
+                status = await conn.copy_from_query(
+                    self.EXPORT_QUERIES[table], output=write, format='csv', header=True
+                )
+        return int(status.split()[-1]), time.monotonic() - started_at
+
+    async def export_changes(self, table, path, consumer='analytics', lag_seconds=60):
+        """Write rows of `table` changed since the consumer's last run as JSON Lines.
+
+        Rows are exported up to `lag_seconds` before now so that transactions
+        still in flight are picked up next time; the watermark only moves if the
+        whole file was written. Returns (row_count, new_watermark).
+        Deleted rows are not reported.
+        """
+        if table not in self.EXPORT_QUERIES:
+            raise ValueError(f"Unknown export {table!r}, expected one of {', '.join(self.EXPORT_QUERIES)}")
+
+        name = f"{consumer}:{table}"
+        rows = 0
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO export_watermarks (name, watermark) VALUES ($1, '-infinity')
+                    ON CONFLICT (name) DO NOTHING
+                ''', name)
+                # The row lock also keeps two exports for the same consumer from overlapping
+                since = await conn.fetchval(
+                    'SELECT watermark FROM export_watermarks WHERE name = $1 FOR UPDATE', name)
+                until = await conn.fetchval(
+                    "SELECT LOCALTIMESTAMP - make_interval(secs => $1)", lag_seconds)
+
+                with open(path, 'w', encoding='utf-8') as f:
+                    # table is one of the EXPORT_QUERIES keys checked above
+                    async for row in conn.cursor(f'''
+                        SELECT row_to_json(t)::text AS line FROM {table} t
+                        WHERE updated_at > $1 AND updated_at <= $2
+                        ORDER BY updated_at
+                    ''', since, until, prefetch=1000):
+                        f.write(row['line'] + '\n')
+                        rows += 1
+
+                await conn.execute('''
+                    UPDATE export_watermarks SET watermark = $2, updated_at = CURRENT_TIMESTAMP
+                    WHERE name = $1
+                ''', name, until)
+        return rows, until
 
     async def add_faq_item(self, question_uz, answer_uz, question_ru=None, answer_ru=None, question_en=None,
                            answer_en=None):
@@ -100,11 +295,78 @@ class AdminPanel:
                 ORDER BY p.created_at ASC
             ''')
 
+    async def get_broadcast_jobs(self, limit=20):
+        """Get recent broadcast jobs with their throughput and failure counts"""
+        async with self.pool.acquire() as conn:
+            return await conn.fetch('''
+                SELECT
+                    id,
+                    job_key,
+                    status,
+                    total,
+                    sent,
+                    skipped,
+                    failed,
+                    created_at,
+                    finished_at,
+                    sent / GREATEST(EXTRACT(EPOCH FROM COALESCE(finished_at, updated_at) - created_at), 1)
+                        as messages_per_second
+                FROM broadcast_jobs
+                ORDER BY created_at DESC
+                LIMIT $1
+            ''', limit)
+
+    async def preview_segment(self, segment):
+        """Count the users a segment would reach without fetching them"""
+        query, args = segment.count_query()
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(query, *args)
+
+    async def queue_segment_broadcast(self, segment, texts):
+        """Queue a broadcast for the bot's leader to send (notifications.run_queued_broadcasts).
+
+        The admin panel never sends itself: the bot keeps the only send budget
+        and a queued job has a single owner. Returns the job key, or None on a clash.
+        """
+        job_key = f"segment:{datetime.now():%Y-%m-%d %H:%M:%S}"
+        params = {'segment': segment.to_params(), 'texts': texts}
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval('''
+                INSERT INTO broadcast_jobs (job_key, name, status, params)
+                VALUES ($1, 'segment', 'queued', $2::jsonb)
+                ON CONFLICT (job_key) DO NOTHING
+                RETURNING job_key
+            ''', job_key, json.dumps(params))
+
     async def close_pool(self):
         if self.pool:
             await self.pool.close()
 
 
+USERS_PAGE_SIZE = 20
+
+
+def print_user(user):
+    print(
+        f"ID: {user['telegram_id']} | Ism: {user['full_name']} | Tel: {user['phone']} | Viloyat: {user['region']} | To'lov: {'✅' if user['payment_status'] else '❌'} | Referallar: {user['referral_count']}")
+
+
+def input_segment():
+    print("\n=== Segment (bo'sh qoldirish = filtrsiz) ===")
+    languages = input("Tillar (uz,ru,en): ").strip()
+    regions = input("Viloyatlar (vergul bilan): ").strip()
+    paid = input("To'lov qilganmi? (ha/yo'q): ").strip().lower()
+    min_age = input("Yosh (dan): ").strip()
+    max_age = input("Yosh (gacha): ").strip()
+    return Segment(
+        languages=[lang.strip() for lang in languages.split(',')] if languages else None,
+        regions=[region.strip() for region in regions.split(',')] if regions else None,
+        paid={'ha': True, "yo'q": False}.get(paid),
+        min_age=int(min_age) if min_age else None,
+        max_age=int(max_age) if max_age else None
+    )
+
+
 # CLI interface for admin panel
 async def admin_cli():
     """Command line interface for admin operations"""
@@ -113,22 +375,34 @@ async def admin_cli():
 
     while True:
         print("\n=== ESL Bot Admin Panel ===")
-        print("1. Ko'rish - Barcha foydalanuvchilar")
+        print("1. Ko'rish - Foydalanuvchilar (sahifalab)")
         print("2. Ko'rish - To'lov statistikasi")
         print("3. Ko'rish - Referal statistikasi")
-        print("4. Eksport - Foydalanuvchilar CSV")
+        print("4. Eksport - CSV (users/payments/questions)")
         print("5. Qo'shish - FAQ elementi")
         print("6. Ko'rish - Kutilayotgan to'lovlar")
+        print("7. Ko'rish - Xabar yuborish (broadcast) ishlari")
+        print("8. Tuzatish - Referal hisoblagichlari")
+        print("9. Ko'rish - Auditoriya segmenti hajmi")
+        print("10. Eksport - O'zgarishlar (JSON Lines)")
+        print("11. Qidirish - Foydalanuvchi (ism yoki telefon)")
+        print("12. Yuborish - Segmentga xabar")
         print("0. Chiqish")
 
-        choice = input("\nTanlang (0-6): ")
+        choice = input("\nTanlang (0-12): ")
 
         if choice == "1":
-            users = await admin.get_all_users()
-            print(f"\n=== Jami foydalanuvchilar: {len(users)} ===")
-            for user in users:
-                print(
-                    f"ID: {user['telegram_id']} | Ism: {user['full_name']} | Tel: {user['phone']} | Viloyat: {user['region']} | To'lov: {'✅' if user['payment_status'] else '❌'} | Referallar: {user['referral_count']}")
+            after = None
+            while True:
+                users = await admin.list_users(USERS_PAGE_SIZE, after)
+                for user in users:
+                    print_user(user)
+                if len(users) < USERS_PAGE_SIZE:
+                    print("=== Ro'yxat oxiri ===")
+                    break
+                after = (users[-1]['created_at'], users[-1]['telegram_id'])
+                if input("Keyingi sahifa? (Enter - ha, q - chiqish): ").strip().lower() == "q":
+                    break
 
         elif choice == "2":
             stats = await admin.get_payment_statistics()
@@ -137,6 +411,9 @@ async def admin_cli():
             print(f"Tasdiqlangan: {stats['approved_payments']}")
             print(f"Rad etilgan: {stats['rejected_payments']}")
             print(f"Kutilayotgan: {stats['pending_payments']}")
+            print(f"\n=== Ro'yxatdan o'tishlar (7 kun) ===")
+            for row in await admin.get_signup_statistics():
+                print(f"{row['day']}: {row['signups']}")
 
         elif choice == "3":
             refs = await admin.get_referral_statistics()
@@ -146,10 +423,11 @@ async def admin_cli():
                     f"{ref['full_name']} | Referallar: {ref['actual_referrals']} | To'lov qilganlar: {ref['paid_referrals']}")
 
         elif choice == "4":
-            csv_content = await admin.export_users_csv()
-            with open("users_export.csv", "w", encoding="utf-8") as f:
-                f.write(csv_content)
-            print("✅ users_export.csv fayli yaratildi!")
+            table = input("Jadval (users/payments/questions) [users]: ").strip() or "users"
+            compress = input("Gzip bilan siqilsinmi? (ha/yo'q) [yo'q]: ").strip().lower() == "ha"
+            path = f"{table}_export.csv" + (".gz" if compress else "")
+            rows, elapsed = await admin.export_csv(table, path)
+            print(f"✅ {path} fayli yaratildi! {rows} qator, {elapsed:.1f} s")
 
         elif choice == "5":
             print("\n=== FAQ qo'shish ===")
@@ -169,6 +447,54 @@ async def admin_cli():
             for payment in payments:
                 print(f"ID: {payment['id']} | Foydalanuvchi: {payment['full_name']} | Vaqt: {payment['created_at']}")
 
+        elif choice == "7":
+            jobs = await admin.get_broadcast_jobs()
+            print(f"\n=== Broadcast ishlari: {len(jobs)} ===")
+            for job in jobs:
+                print(
+                    f"{job['job_key']} | Holat: {job['status']} | Yuborildi: {job['sent']} | "
+                    f"O'tkazildi: {job['skipped']} | Xato: {job['failed']} | "
+                    f"Tezlik: {job['messages_per_second']:.1f} msg/s")
+
+        elif choice == "8":
+            fixed = await admin.repair_referral_counters()
+            print(f"✅ Referal hisoblagichlari tekshirildi, tuzatildi: {fixed}")
+
+        elif choice == "9":
+            segment = input_segment()
+            print(f"Segment hajmi: {await admin.preview_segment(segment)} foydalanuvchi")
+
+        elif choice == "10":
+            table = input("Jadval (users/payments/questions) [users]: ").strip() or "users"
+            path = f"{table}_changes.jsonl"
+            rows, watermark = await admin.export_changes(table, path)
+            print(f"✅ {path} fayli yaratildi! {rows} qator, {watermark} gacha")
+
+        elif choice == "11":
+            users = await admin.search_users(input("Ism yoki telefon: "))
+            print(f"\n=== Topildi: {len(users)} ===")
+            for user in users:
+                print_user(user)
+
+        elif choice == "12":
+            segment = input_segment()
+            texts = {'uz': input("Matn (O'zbek): ").strip()}
+            for language, label in (('ru', "Rus"), ('en', "Ingliz")):
+                text = input(f"Matn ({label}, ixtiyoriy - bo'lmasa o'zbekcha yuboriladi): ").strip()
+                if text:
+                    texts[language] = text
+            if not texts['uz']:
+                print("O'zbekcha matn majburiy!")
+                continue
+            size = await admin.preview_segment(segment)
+            if input(f"{size} foydalanuvchiga yuborilsinmi? (ha/yo'q): ").strip().lower() != "ha":
+                continue
+            job_key = await admin.queue_segment_broadcast(segment, texts)
+            if job_key:
+                print(f"✅ {job_key} navbatga qo'yildi, bot bir daqiqa ichida yuborishni boshlaydi (7 - holati)")
+            else:
+                print("⚠️ Shu soniyada boshqa xabar navbatga qo'yilgan, qayta urinib ko'ring")
+
         elif choice == "0":
             break
 
@@ -178,5 +504,66 @@ async def admin_cli():
     await admin.close_pool()
 
 
+async def admin_command(args):
+    """Non-interactive commands: exports (e.g. for a nightly cron job) and user lookup"""
+    admin = AdminPanel()
+    await admin.create_pool()
+    try:
+        if args.command == 'users':
+            after = None
+            if args.after:
+                created_at, telegram_id = args.after.rsplit(',', 1)
+                after = (datetime.fromisoformat(created_at), int(telegram_id))
+            users = await admin.list_users(args.limit, after)
+            for user in users:
+                print_user(user)
+            if len(users) == args.limit:
+                last = users[-1]
+                print(f"--after {last['created_at'].isoformat()},{last['telegram_id']}")
+            return
+
+        if args.command == 'search':
+            for user in await admin.search_users(args.query, args.limit):
+                print_user(user)
+            return
+
+        for table in args.tables:
+            path = os.path.join(args.output_dir, f"{table}_{args.command.replace('-', '_')}"
+                                f"{'.csv.gz' if args.command == 'export' else '.jsonl'}")
+            if args.command == 'export':
+                rows, elapsed = await admin.export_csv(table, path)
+                print(f"{path}: {rows} rows in {elapsed:.1f}s")
+            else:
+                rows, watermark = await admin.export_changes(table, path, consumer=args.consumer)
+                print(f"{path}: {rows} rows changed up to {watermark}")
+    finally:
+        await admin.close_pool()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ESL Bot admin panel; runs the interactive menu without a command")
+    subparsers = parser.add_subparsers(dest='command')
+    for command, help_text in (('export', "full CSV export"),
+                               ('export-changes', "rows changed since the last run, as JSON Lines")):
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument('--tables', nargs='+', choices=list(AdminPanel.EXPORT_QUERIES), default=['users'])
+        sub.add_argument('--output-dir', default='.')
+        if command == 'export-changes':
+            sub.add_argument('--consumer', default='analytics', help="watermark name")
+
+    users = subparsers.add_parser('users', help="one page of users, newest first")
+    users.add_argument('--limit', type=int, default=USERS_PAGE_SIZE)
+    users.add_argument('--after', help="cursor printed at the end of the previous page")
+
+    search = subparsers.add_parser('search', help="find users by name or phone")
+    search.add_argument('query')
+    search.add_argument('--limit', type=int, default=USERS_PAGE_SIZE)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    asyncio.run(admin_cli())
+    args = parse_args()
+    if args.command:
+        asyncio.run(admin_command(args))
+    else:
+        asyncio.run(admin_cli())
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 
@@ -7,3 +8,76 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
 ADMIN_GROUP_ID = int(os.getenv('ADMIN_GROUP_ID', 0))
 SECRET_GROUP_LINK = os.getenv('SECRET_GROUP_LINK')
+
+# Conversation (FSM) state: postgres, redis (needs the redis package) or memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'postgres')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Conversations untouched for this many seconds are forgotten
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 7 * 24 * 60 * 60))
+# Abandoned registrations and one-answer prompts (payment, question, settings) expire sooner
+FSM_REGISTRATION_TTL = int(os.getenv('FSM_REGISTRATION_TTL', 24 * 60 * 60))
+FSM_PROMPT_TTL = int(os.getenv('FSM_PROMPT_TTL', 60 * 60))
+# Seconds between sweeps of expired in-process (FSM_STORAGE=memory) sessions
+FSM_SWEEP_INTERVAL = float(os.getenv('FSM_SWEEP_INTERVAL', 60))
+
+# How updates arrive: polling or webhook. Both serve /healthy and /ready on PORT
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('PORT', 5000))
+# Public HTTPS base URL Telegram posts updates to, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token; derived from the token so replicas agree
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256((BOT_TOKEN or '').encode()).hexdigest()
+
+# Updates handled at the same time in one process; a chat's updates always run one by one
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 100))
+
+# With more than one worker, this process only receives updates and hands each
+# user's updates to one of SHARD_WORKERS processes (sharding.py)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 1))
+# Updates waiting per worker, both in its inter-process queue and in the worker itself;
+# inside a worker, UPDATE_CONCURRENCY limits how many are handled at once
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', 10000))
+# asyncpg connections per process; every sharded worker opens its own pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+
+# Per-process cache of user profiles used by the handlers; with several replicas or
+# sharded workers a profile change made elsewhere shows up here within the TTL
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 10000))
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 300))
+# Seconds the admin panel reuses statistics read from the rollup tables
+STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 60))
+
+# Broadcast throughput: Telegram allows roughly 30 messages/s per bot and 1/s per chat
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 28))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 16))
+BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', 1.0))
+# Broadcast audiences are read from Postgres in pages of this many users
+AUDIENCE_PAGE_SIZE = int(os.getenv('AUDIENCE_PAGE_SIZE', 1000))
+
+# Interrupted broadcasts younger than this are resumed on startup
+BROADCAST_RESUME_HOURS = int(os.getenv('BROADCAST_RESUME_HOURS', 6))
+# Delivery results are written to Postgres in batches of this size
+BROADCAST_CHECKPOINT_BATCH = int(os.getenv('BROADCAST_CHECKPOINT_BATCH', 200))
+
+# Time zone used for scheduled jobs
+SCHEDULER_TIMEZONE = os.getenv('SCHEDULER_TIMEZONE', 'Asia/Tashkent')
+
+# Replicas compete for this Postgres advisory lock; the holder runs scheduled jobs
+LEADER_LOCK_ID = int(os.getenv('LEADER_LOCK_ID', 530174))
+LEADER_RETRY_INTERVAL = float(os.getenv('LEADER_RETRY_INTERVAL', 5))
+
+# Public channel users must join; the bot is an admin there and receives chat_member updates
+CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME', '@ESL_Proficiency')
+# Membership rows older than this are re-checked with get_chat_member
+CHANNEL_MEMBERSHIP_TTL = int(os.getenv('CHANNEL_MEMBERSHIP_TTL', 24 * 60 * 60))
+
+# Background forwarding of payment screenshots to the admin group
+PAYMENT_FORWARD_QUEUE_SIZE = int(os.getenv('PAYMENT_FORWARD_QUEUE_SIZE', 1000))
+PAYMENT_FORWARD_WORKERS = int(os.getenv('PAYMENT_FORWARD_WORKERS', 2))
+PAYMENT_FORWARD_MAX_ATTEMPTS = int(os.getenv('PAYMENT_FORWARD_MAX_ATTEMPTS', 8))
+
+# Delivery of queued user notifications (outbox)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
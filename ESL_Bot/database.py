@@ -1,117 +1,154 @@
 import asyncpg
 import asyncio
-from config import DATABASE_URL
+import json
+import time
+from collections import OrderedDict
+from config import DATABASE_URL, DB_POOL_SIZE, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, AUDIENCE_PAGE_SIZE
+from migrations import migrate
+
+
+class ProfileCache:
+    """Bounded LRU cache of user rows with a per-entry TTL.
+
+    The cache is per process: a change written by another replica or sharded
+    worker (language, region, payment status...) is seen here only once the
+    entry expires, so profile fields can be up to `ttl` seconds stale.
+    """
+
+    def __init__(self, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, telegram_id):
+        """Return (hit, row); expired entries count as misses"""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return False, None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            del self._entries[telegram_id]
+            return False, None
+        self._entries.move_to_end(telegram_id)
+        return True, row
+
+    def set(self, telegram_id, row):
+        self._entries[telegram_id] = (time.monotonic() + self.ttl, row)
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        self._entries.clear()
 
 
 class Database:
     def __init__(self):
         self.pool = None
+        self.profile_cache = ProfileCache()
 
     async def create_pool(self):
-        self.pool = await asyncpg.create_pool(DATABASE_URL)
+        self.pool = await asyncpg.create_pool(DATABASE_URL, min_size=DB_POOL_SIZE, max_size=DB_POOL_SIZE)
 
     async def close_pool(self):
         if self.pool:
             await self.pool.close()
 
     async def init_db(self):
-        async with self.pool.acquire() as conn:
-            # Users table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    full_name VARCHAR(255) NOT NULL,
-                    phone VARCHAR(20),
-                    age INTEGER,
-                    region VARCHAR(100),
-                    language VARCHAR(10) DEFAULT 'uz',
-                    referrer_id BIGINT,
-                    referral_count INTEGER DEFAULT 0,
-                    payment_status BOOLEAN DEFAULT FALSE,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # Payments table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS payments (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    screenshot_file_id VARCHAR(255),
-                    status VARCHAR(20) DEFAULT 'pending',
-                    admin_message_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(telegram_id)
-                )
-            ''')
-
-            # Questions table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS questions (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    question TEXT NOT NULL,
-                    answered BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(telegram_id)
-                )
-            ''')
-
-            # FAQ table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS faq (
-                    id SERIAL PRIMARY KEY,
-                    question_uz TEXT,
-                    answer_uz TEXT,
-                    question_ru TEXT,
-                    answer_ru TEXT,
-                    question_en TEXT,
-                    answer_en TEXT
-                )
-            ''')
+        await migrate(self.pool)
 
     async def add_user(self, telegram_id, full_name, phone=None, age=None, region=None, language='uz',
                        referrer_id=None):
+        # One statement, so the upsert and the referral credit commit or fail together.
+        # The referrer is credited only when the row is new, the referrer exists and
+        # is not the user themselves; otherwise referrer_id is stored as NULL.
         async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO users (telegram_id, full_name, phone, age, region, language, referrer_id)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                ON CONFLICT (telegram_id) DO UPDATE SET
-                full_name = $2, phone = $3, age = $4, region = $5, language = $6
+            user = await conn.fetchrow('''
+                WITH referrer AS (
+                    SELECT telegram_id FROM users WHERE telegram_id = $7 AND telegram_id <> $1
+                ), upserted AS (
+                    INSERT INTO users (telegram_id, full_name, phone, age, region, language, referrer_id)
+                    VALUES ($1, $2, $3, $4, $5, $6, (SELECT telegram_id FROM referrer))
+                    ON CONFLICT (telegram_id) DO UPDATE SET
+                    full_name = $2, phone = $3, age = $4, region = $5, language = $6, is_active = TRUE
+                    RETURNING users.*, (xmax = 0) AS inserted
+                ), credited AS (
+                    UPDATE users SET referral_count = referral_count + 1
+                    WHERE telegram_id = (SELECT telegram_id FROM referrer)
+                      AND (SELECT inserted FROM upserted)
+                    RETURNING telegram_id
+                )
+                SELECT upserted.*, (SELECT telegram_id FROM credited) AS credited_referrer
+                FROM upserted
             ''', telegram_id, full_name, phone, age, region, language, referrer_id)
 
-            # Update referrer count
-            if referrer_id:
-                await conn.execute('''
-                    UPDATE users SET referral_count = referral_count + 1
-                    WHERE telegram_id = $1
-                ''', referrer_id)
+        if user['credited_referrer']:
+            self.profile_cache.invalidate(user['credited_referrer'])
+        self.profile_cache.set(telegram_id, user)
+        return user
 
     async def get_user(self, telegram_id):
+        hit, user = self.profile_cache.get(telegram_id)
+        if hit:
+            return user
         async with self.pool.acquire() as conn:
-            return await conn.fetchrow('SELECT * FROM users WHERE telegram_id = $1', telegram_id)
+            user = await conn.fetchrow('SELECT * FROM users WHERE telegram_id = $1', telegram_id)
+        # Misses are not cached: the user may be registering on another replica right now
+        if user is not None:
+            self.profile_cache.set(telegram_id, user)
+        return user
 
-    async def update_user_language(self, telegram_id, language):
+    async def _update_user_field(self, telegram_id, column, value):
+        # Column names come from the update_user_* methods below, never from user input
         async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET language = $1 WHERE telegram_id = $2', language, telegram_id)
+            user = await conn.fetchrow(
+                f'UPDATE users SET {column} = $1 WHERE telegram_id = $2 RETURNING *', value, telegram_id)
+        if user is None:
+            self.profile_cache.invalidate(telegram_id)
+        else:
+            self.profile_cache.set(telegram_id, user)
+        return user
+
+    async def update_user_language(self, telegram_id, language):
+        return await self._update_user_field(telegram_id, 'language', language)
 
     async def update_user_age(self, telegram_id, age):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET age = $1 WHERE telegram_id = $2', age, telegram_id)
+        return await self._update_user_field(telegram_id, 'age', age)
 
     async def update_user_name(self, telegram_id, full_name):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET full_name = $1 WHERE telegram_id = $2', full_name, telegram_id)
+        return await self._update_user_field(telegram_id, 'full_name', full_name)
 
     async def update_user_phone(self, telegram_id, phone):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET phone = $1 WHERE telegram_id = $2', phone, telegram_id)
+        return await self._update_user_field(telegram_id, 'phone', phone)
 
     async def update_user_region(self, telegram_id, region):
+        return await self._update_user_field(telegram_id, 'region', region)
+
+    async def deactivate_users(self, telegram_ids):
+        """Mark users who blocked the bot or deleted their account as unreachable"""
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                'UPDATE users SET is_active = FALSE WHERE telegram_id = ANY($1::bigint[]) AND is_active',
+                telegram_ids)
+        for telegram_id in telegram_ids:
+            self.profile_cache.invalidate(telegram_id)
+
+    async def reactivate_user(self, telegram_id):
+        """Mark the user active again; a no-op unless they were deactivated.
+
+        Deactivation may have happened in another process whose cache this one
+        never hears about, so the check is done by the database, not the cache.
+        """
         async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE users SET region = $1 WHERE telegram_id = $2', region, telegram_id)
+            result = await conn.execute(
+                'UPDATE users SET is_active = TRUE WHERE telegram_id = $1 AND NOT is_active', telegram_id)
+        if result != 'UPDATE 0':
+            self.profile_cache.invalidate(telegram_id)
+            return True
+        return False
 
     async def add_payment(self, user_id, screenshot_file_id):
         async with self.pool.acquire() as conn:
@@ -120,17 +157,159 @@ class Database:
                 VALUES ($1, $2) RETURNING id
             ''', user_id, screenshot_file_id)
 
-    async def update_payment_status(self, payment_id, status):
+    async def claim_payment_forward(self, payment_id, lease_seconds):
+        """Lease a pending forward for this worker and return what the admin message needs"""
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow('''
+                UPDATE payments p
+                SET next_forward_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+                FROM users u
+                WHERE p.id = $1 AND u.telegram_id = p.user_id
+                  AND p.forward_status = 'pending' AND p.next_forward_at <= CURRENT_TIMESTAMP
+                RETURNING p.id, p.user_id, p.screenshot_file_id, p.forward_attempts,
+                          u.full_name, u.phone, u.region
+            ''', payment_id, lease_seconds)
+
+    async def get_due_payment_forwards(self, limit):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT id FROM payments
+                WHERE forward_status = 'pending' AND next_forward_at <= CURRENT_TIMESTAMP
+                ORDER BY next_forward_at
+                LIMIT $1
+            ''', limit)
+            return [row['id'] for row in rows]
+
+    async def mark_payment_forwarded(self, payment_id, admin_message_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE payments SET forward_status = 'forwarded', admin_message_id = $2
+                WHERE id = $1
+            ''', payment_id, admin_message_id)
+
+    async def reschedule_payment_forward(self, payment_id, delay_seconds, give_up=False):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE payments
+                SET forward_attempts = forward_attempts + 1,
+                    next_forward_at = CURRENT_TIMESTAMP + make_interval(secs => $2),
+                    forward_status = CASE WHEN $3 THEN 'failed' ELSE forward_status END
+                WHERE id = $1
+            ''', payment_id, delay_seconds, give_up)
+
+    async def _set_payment_status(self, conn, telegram_id, paid):
+        """Flip users.payment_status and keep the referrer's paid_referral_count in step.
+
+        Must run inside the caller's transaction; does nothing if the flag already has that value.
+        """
+        referrer_id = await conn.fetchval('''
+            UPDATE users SET payment_status = $2
+            WHERE telegram_id = $1 AND payment_status IS DISTINCT FROM $2
+            RETURNING referrer_id
+        ''', telegram_id, paid)
+        if referrer_id:
+            await conn.execute('''
+                UPDATE users SET paid_referral_count = GREATEST(paid_referral_count + $2, 0)
+                WHERE telegram_id = $1
+            ''', referrer_id, 1 if paid else -1)
+            self.profile_cache.invalidate(referrer_id)
+        self.profile_cache.invalidate(telegram_id)
+
+    async def decide_payment(self, payment_id, decision, notify=None):
+        """Approve or reject a pending payment in one transaction.
+
+        `notify(language)` returns the text to send the user; it is written to
+        the outbox in the same transaction. Returns None for an unknown payment,
+        otherwise a record with the user's telegram_id and language, the previous
+        status and `decided`, which is False when another admin already decided
+        the payment.
+        """
         async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE payments SET status = $1 WHERE id = $2', status, payment_id)
-            if status == 'approved':
-                # Get user_id and update payment_status
-                user_id = await conn.fetchval('SELECT user_id FROM payments WHERE id = $1', payment_id)
-                await conn.execute('UPDATE users SET payment_status = TRUE WHERE telegram_id = $1', user_id)
+            async with conn.transaction():
+                # FOR UPDATE makes a concurrent click wait and then see the committed status
+                result = await conn.fetchrow('''
+                    WITH locked AS (
+                        SELECT id, user_id, status FROM payments WHERE id = $1 FOR UPDATE
+                    ), updated AS (
+                        UPDATE payments p SET status = $2
+                        FROM locked
+                        WHERE p.id = locked.id AND locked.status = 'pending'
+                        RETURNING p.id
+                    )
+                    SELECT u.telegram_id, u.language, locked.status AS previous_status,
+                           EXISTS (SELECT 1 FROM updated) AS decided
+                    FROM locked
+                    JOIN users u ON u.telegram_id = locked.user_id
+                ''', payment_id, decision)
+                if result and result['decided']:
+                    if decision == 'approved':
+                        await self._set_payment_status(conn, result['telegram_id'], True)
+                    if notify:
+                        await self._enqueue_outbox(
+                            conn, f"payment:{payment_id}:{decision}", result['telegram_id'],
+                            'send_message', {'text': notify(result['language'])})
+                return result
 
     async def add_question(self, user_id, question):
+        """Store a question and return its id, which the admin group message carries"""
         async with self.pool.acquire() as conn:
-            await conn.execute('INSERT INTO questions (user_id, question) VALUES ($1, $2)', user_id, question)
+            return await conn.fetchval(
+                'INSERT INTO questions (user_id, question) VALUES ($1, $2) RETURNING id', user_id, question)
+
+    async def answer_question(self, user_id, question_id, dedup_key, method, payload):
+        """Mark the question the admin replied to as answered and queue the reply.
+
+        `question_id` is None for admin messages sent before questions carried
+        their id; the reply is still delivered, but no question is marked.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if question_id is not None:
+                    await conn.execute(
+                        'UPDATE questions SET answered = TRUE WHERE id = $1 AND user_id = $2',
+                        question_id, user_id)
+                await self._enqueue_outbox(conn, dedup_key, user_id, method, payload)
+
+    @staticmethod
+    async def _enqueue_outbox(conn, dedup_key, chat_id, method, payload):
+        """Queue a Bot API call; a repeated dedup_key is ignored"""
+        await conn.execute('''
+            INSERT INTO outbox (dedup_key, chat_id, method, payload) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (dedup_key) DO NOTHING
+        ''', dedup_key, chat_id, method, json.dumps(payload))
+
+    async def claim_outbox_batch(self, limit, lease_seconds):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('''
+                UPDATE outbox SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY id
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, method, payload, attempts
+            ''', limit, lease_seconds)
+            return [{**row, 'payload': json.loads(row['payload'])} for row in rows]
+
+    async def mark_outbox_sent(self, ids):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE outbox SET status = 'sent', attempts = attempts + 1, delivered_at = CURRENT_TIMESTAMP
+                WHERE id = ANY($1::bigint[])
+            ''', ids)
+
+    async def mark_outbox_failed(self, failures):
+        """Record (id, error, retry_in_seconds or None to give up) for failed deliveries"""
+        async with self.pool.acquire() as conn:
+            await conn.executemany('''
+                UPDATE outbox
+                SET attempts = attempts + 1, last_error = $2,
+                    status = CASE WHEN $3::float8 IS NULL THEN 'failed' ELSE status END,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => COALESCE($3::float8, 0))
+                WHERE id = $1
+            ''', failures)
 
     async def get_faq(self, language):
         async with self.pool.acquire() as conn:
@@ -149,11 +328,58 @@ class Database:
             return await conn.fetch(
                 'SELECT telegram_id, language FROM users WHERE payment_status = TRUE AND is_active = TRUE')
 
+    async def _iter_keyset(self, query, *args, chunk_size=AUDIENCE_PAGE_SIZE):
+        """Yield rows page by page ordered by telegram_id.
+
+        `query` must filter on `telegram_id > $1`, order by telegram_id and
+        `LIMIT $2`; extra arguments start at $3. A pool connection is held only
+        while a page is fetched.
+        """
+        after = -2 ** 63
+        while True:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(query, after, chunk_size, *args)
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1]['telegram_id']
+
+    def iter_users_for_notification(self, chunk_size=AUDIENCE_PAGE_SIZE):
+        return self._iter_keyset('''
+            SELECT telegram_id, language FROM users
+            WHERE payment_status = TRUE AND is_active = TRUE AND telegram_id > $1
+            ORDER BY telegram_id
+            LIMIT $2
+        ''', chunk_size=chunk_size)
+
+    def iter_all_users(self, chunk_size=AUDIENCE_PAGE_SIZE):
+        return self._iter_keyset('''
+            SELECT telegram_id, language FROM users
+            WHERE is_active = TRUE AND telegram_id > $1
+            ORDER BY telegram_id
+            LIMIT $2
+        ''', chunk_size=chunk_size)
+
+    def iter_discount_audience(self, chunk_size=AUDIENCE_PAGE_SIZE):
+        """Paid users with at least one paid referral"""
+        return self._iter_keyset('''
+            SELECT telegram_id, full_name, language, paid_referral_count as paid_referrals
+            FROM users
+            WHERE payment_status = TRUE AND paid_referral_count > 0 AND telegram_id > $1
+            ORDER BY telegram_id
+            LIMIT $2
+        ''', chunk_size=chunk_size)
+
+    def iter_segment(self, segment, chunk_size=AUDIENCE_PAGE_SIZE):
+        """Stream the users matching a segments.Segment"""
+        query, args = segment.keyset_query()
+        return self._iter_keyset(query, *args, chunk_size=chunk_size)
+
     async def get_referral_stats(self, telegram_id):
         async with self.pool.acquire() as conn:
             return await conn.fetchrow('''
-                SELECT referral_count, 
-                       (SELECT COUNT(*) FROM users WHERE referrer_id = $1 AND payment_status = TRUE) as paid_referrals
+                SELECT referral_count, paid_referral_count as paid_referrals
                 FROM users WHERE telegram_id = $1
             ''', telegram_id)
 
@@ -161,5 +387,108 @@ class Database:
         async with self.pool.acquire() as conn:
             return await conn.fetch('SELECT telegram_id, language FROM users WHERE is_active = TRUE')
 
+    async def start_broadcast_job(self, job_key, name, params=None):
+        """Create the job or return the existing one with the same key.
+
+        `params` (JSON-serializable) is kept with the job for resume_broadcasts;
+        a resumed job keeps the params it was created with.
+        """
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow('''
+                INSERT INTO broadcast_jobs (job_key, name, params) VALUES ($1, $2, $3::jsonb)
+                ON CONFLICT (job_key) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+                RETURNING id, job_key, name, status
+            ''', job_key, name, json.dumps(params) if params is not None else None)
+
+    async def get_delivered_recipients(self, job_id):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT telegram_id FROM broadcast_deliveries WHERE job_id = $1', job_id)
+            return {row['telegram_id'] for row in rows}
+
+    async def record_broadcast_deliveries(self, job_id, deliveries):
+        """Store a batch of (telegram_id, status, error) results and bump the job counters"""
+        sent = sum(1 for _, status, _ in deliveries if status == 'sent')
+        skipped = sum(1 for _, status, _ in deliveries if status == 'skipped')
+        failed = sum(1 for _, status, _ in deliveries if status == 'failed')
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany('''
+                    INSERT INTO broadcast_deliveries (job_id, telegram_id, status, error)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (job_id, telegram_id) DO NOTHING
+                ''', [(job_id, telegram_id, status, error) for telegram_id, status, error in deliveries])
+                await conn.execute('''
+                    UPDATE broadcast_jobs
+                    SET sent = sent + $2, skipped = skipped + $3, failed = failed + $4,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = $1
+                ''', job_id, sent, skipped, failed)
+
+    async def finish_broadcast_job(self, job_id, status, total):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE broadcast_jobs
+                SET status = $2, total = GREATEST(total, $3),
+                    updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+                WHERE id = $1
+            ''', job_id, status, total)
+
+    async def claim_queued_broadcast_job(self):
+        """Move the oldest job queued by the admin panel to 'running' and return it"""
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                UPDATE broadcast_jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT id FROM broadcast_jobs WHERE status = 'queued'
+                    ORDER BY created_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, job_key, name, params
+            ''')
+            return {**row, 'params': json.loads(row['params'])} if row else None
+
+    async def get_resumable_broadcast_jobs(self, max_age_hours):
+        """Return interrupted jobs that are still recent enough to finish; older ones are abandoned"""
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE broadcast_jobs SET status = 'abandoned', updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'running'
+                  AND created_at < CURRENT_TIMESTAMP - make_interval(hours => $1)
+            ''', max_age_hours)
+            rows = await conn.fetch(
+                "SELECT id, job_key, name, params FROM broadcast_jobs WHERE status = 'running' ORDER BY created_at")
+            return [{**row, 'params': json.loads(row['params']) if row['params'] else None} for row in rows]
+
+    async def set_channel_membership(self, telegram_id, status):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO channel_members (telegram_id, status) VALUES ($1, $2)
+                ON CONFLICT (telegram_id) DO UPDATE SET status = $2, updated_at = CURRENT_TIMESTAMP
+            ''', telegram_id, status)
+
+    async def get_channel_membership(self, telegram_id, ttl_seconds):
+        """Return the stored membership status, or None if unknown or older than the TTL"""
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval('''
+                SELECT status FROM channel_members
+                WHERE telegram_id = $1 AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2)
+            ''', telegram_id, ttl_seconds)
+
+    def iter_users_not_in_channel(self, ttl_seconds, chunk_size=AUDIENCE_PAGE_SIZE):
+        """Active users not known to be channel members (including unknown or stale entries)"""
+        return self._iter_keyset('''
+            SELECT u.telegram_id, u.language
+            FROM users u
+            LEFT JOIN channel_members m ON m.telegram_id = u.telegram_id
+            WHERE u.is_active = TRUE
+              AND (m.telegram_id IS NULL
+                   OR m.status NOT IN ('member', 'administrator', 'creator')
+                   OR m.updated_at <= CURRENT_TIMESTAMP - make_interval(secs => $3))
+              AND u.telegram_id > $1
+            ORDER BY u.telegram_id
+            LIMIT $2
+        ''', ttl_seconds, chunk_size=chunk_size)
+
 
 db = Database()
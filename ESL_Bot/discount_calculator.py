@@ -2,9 +2,8 @@
 Referal discount calculator and monthly checker
 """
 
-import asyncio
-from datetime import datetime, timedelta
 from database import db
+from scheduler import scheduler
 from texts import TEXTS
 
 
@@ -34,62 +33,39 @@ class DiscountCalculator:
         return max(0, discounted_price)
 
     @classmethod
-    async def send_monthly_discount_notifications(cls):
-        """Send monthly discount notifications to all users"""
-        async with db.pool.acquire() as conn:
-            users = await conn.fetch('''
-                SELECT 
-                    u.telegram_id,
-                    u.full_name,
-                    u.language,
-                    COUNT(r.telegram_id) as paid_referrals
-                FROM users u
-                LEFT JOIN users r ON u.telegram_id = r.referrer_id AND r.payment_status = TRUE
-                WHERE u.payment_status = TRUE
-                GROUP BY u.telegram_id, u.full_name, u.language
-                HAVING COUNT(r.telegram_id) > 0
-            ''')
-
-        from main import bot
-
-        for user in users:
-            try:
-                paid_refs = user['paid_referrals']
-                discount = cls.calculate_discount(paid_refs)
-                new_price = cls.calculate_price(paid_refs)
-
-                lang = user['language']
-
-                if lang == 'uz':
-                    message = f"🎉 Tabriklaymiz! Sizning referalingiz orqali {paid_refs} nafar foydalanuvchi to'lov qildi.\n"
-                    message += f"💰 Sizga {discount}% chegirma berildi!\n"
-                    message += f"💵 Keyingi oy narxi: ${new_price}"
-                elif lang == 'ru':
-                    message = f"🎉 Поздравляем! Через вашу реферальную ссылку {paid_refs} пользователей оплатили.\n"
-                    message += f"💰 Вам предоставлена скидка {discount}%!\n"
-                    message += f"💵 Цена на следующий месяц: ${new_price}"
-                else:
-                    message = f"🎉 Congratulations! {paid_refs} users paid through your referral link.\n"
-                    message += f"💰 You received a {discount}% discount!\n"
-                    message += f"💵 Next month's price: ${new_price}"
-
-                await bot.send_message(user['telegram_id'], message)
-                await asyncio.sleep(0.1)  # Rate limiting
-
-            except Exception as e:
-                print(f"Failed to send discount notification to {user['telegram_id']}: {e}")
-
-
-# Monthly scheduler for discount notifications
-async def monthly_discount_scheduler():
-    """Schedule monthly discount notifications"""
-    while True:
-        now = datetime.now()
-
-        # Check if it's the last day of the month at 10:00 AM
-        tomorrow = now + timedelta(days=1)
-        if tomorrow.day == 1 and now.hour == 10 and now.minute == 0:
-            await DiscountCalculator.send_monthly_discount_notifications()
-
-        # Sleep for 1 minute
-        await asyncio.sleep(60)
+    async def send_monthly_discount_notifications(cls, bot, job_key=None, due=None):
+        """Send monthly discount notifications to all users; `due` is the scheduled slot"""
+        job_key = job_key or f"monthly_discount:{due or scheduler.now():%Y-%m}"
+        users = db.iter_discount_audience()
+
+        from notifications import broadcaster
+
+        async def send(user):
+            paid_refs = user['paid_referrals']
+            discount = cls.calculate_discount(paid_refs)
+            new_price = cls.calculate_price(paid_refs)
+
+            lang = user['language']
+
+            if lang == 'uz':
+                message = f"🎉 Tabriklaymiz! Sizning referalingiz orqali {paid_refs} nafar foydalanuvchi to'lov qildi.\n"
+                message += f"💰 Sizga {discount}% chegirma berildi!\n"
+                message += f"💵 Keyingi oy narxi: ${new_price}"
+            elif lang == 'ru':
+                message = f"🎉 Поздравляем! Через вашу реферальную ссылку {paid_refs} пользователей оплатили.\n"
+                message += f"💰 Вам предоставлена скидка {discount}%!\n"
+                message += f"💵 Цена на следующий месяц: ${new_price}"
+            else:
+                message = f"🎉 Congratulations! {paid_refs} users paid through your referral link.\n"
+                message += f"💰 You received a {discount}% discount!\n"
+                message += f"💵 Next month's price: ${new_price}"
+
+            await bot.send_message(user['telegram_id'], message)
+
+        return await broadcaster.run(users, send, name='monthly_discount', job_key=job_key)
+
+
+def register_discount_jobs(bot):
+    """Send monthly discount notifications on the last day of the month at 10:00"""
+    scheduler.add_job('monthly_discount', '0 10 L * *',
+                      lambda due: DiscountCalculator.send_monthly_discount_notifications(bot, due=due))
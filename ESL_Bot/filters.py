@@ -0,0 +1,25 @@
+from typing import Any, Dict, Optional, Tuple, Union
+
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+
+class MenuButton(Filter):
+    """Match reply-keyboard buttons by action instead of by localized label.
+
+    The label is resolved once per update by MenuButtonMiddleware; the filter
+    only compares the resolved action and hands the button's language to the
+    handler as `button_lang`.
+    """
+
+    def __init__(self, *actions: str):
+        self.actions = frozenset(actions)
+
+    async def __call__(
+        self,
+        message: Message,
+        menu_button: Optional[Tuple[str, Optional[str]]] = None
+    ) -> Union[bool, Dict[str, Any]]:
+        if menu_button is None or menu_button[0] not in self.actions:
+            return False
+        return {'button_lang': menu_button[1]}
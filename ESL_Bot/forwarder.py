@@ -0,0 +1,108 @@
+"""
+Background forwarding of payment screenshots to the admin group
+"""
+
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter
+from database import db
+from keyboards import payment_admin_keyboard
+from config import (ADMIN_GROUP_ID, PAYMENT_FORWARD_QUEUE_SIZE, PAYMENT_FORWARD_WORKERS,
+                    PAYMENT_FORWARD_MAX_ATTEMPTS)
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentForwarder:
+    """Send new payments to the admin group off the handler's request path.
+
+    The payments row is the source of truth: a payment stays `pending` until
+    the admin message is sent, so anything dropped from the in-memory queue
+    (full queue, restart) is picked up again by the periodic sweep.
+    """
+
+    def __init__(self, queue_size=PAYMENT_FORWARD_QUEUE_SIZE, workers=PAYMENT_FORWARD_WORKERS,
+                 max_attempts=PAYMENT_FORWARD_MAX_ATTEMPTS, sweep_interval=30, lease_seconds=120,
+                 base_delay=5, max_delay=600):
+        self.queue_size = queue_size
+        self.queue = None
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.sweep_interval = sweep_interval
+        self.lease_seconds = lease_seconds
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queued = set()
+
+    def submit(self, payment_id):
+        """Queue a payment for forwarding; never blocks the caller"""
+        if self.queue is None or payment_id in self._queued:
+            return
+        try:
+            self.queue.put_nowait(payment_id)
+            self._queued.add(payment_id)
+        except asyncio.QueueFull:
+            logger.warning(f"Forward queue full, payment {payment_id} left for the sweep")
+
+    def _backoff(self, attempts):
+        return min(self.max_delay, self.base_delay * 2 ** attempts)
+
+    async def _forward(self, bot, payment_id):
+        payment = await db.claim_payment_forward(payment_id, self.lease_seconds)
+        if payment is None:
+            # Already forwarded, not yet due, or leased by another worker/replica
+            return
+        try:
+            admin_message = await bot.send_photo(
+                ADMIN_GROUP_ID,
+                payment['screenshot_file_id'],
+                caption=f"🆔 {payment['user_id']}\n👤 {payment['full_name']}\n📞 {payment['phone']}\n📍 {payment['region']}",
+                reply_markup=payment_admin_keyboard(payment_id)
+            )
+        except Exception as e:
+            attempts = payment['forward_attempts'] + 1
+            delay = e.retry_after if isinstance(e, TelegramRetryAfter) else self._backoff(attempts)
+            give_up = attempts >= self.max_attempts
+            await db.reschedule_payment_forward(payment_id, delay, give_up=give_up)
+            if give_up:
+                logger.error(f"Giving up forwarding payment {payment_id} after {attempts} attempts: {e}")
+            else:
+                logger.warning(f"Forwarding payment {payment_id} failed, retry in {delay}s: {e}")
+            return
+        await db.mark_payment_forwarded(payment_id, admin_message.message_id)
+
+    async def _worker(self, bot):
+        while True:
+            payment_id = await self.queue.get()
+            try:
+                await self._forward(bot, payment_id)
+            except Exception as e:
+                logger.error(f"Forward worker error for payment {payment_id}: {e}")
+            finally:
+                self._queued.discard(payment_id)
+                self.queue.task_done()
+
+    async def _sweep(self):
+        """Requeue payments that are due: retries, expired leases, overflow, pre-restart leftovers"""
+        while True:
+            try:
+                free = self.queue.maxsize - self.queue.qsize()
+                if free > 0:
+                    for payment_id in await db.get_due_payment_forwards(free):
+                        self.submit(payment_id)
+            except Exception as e:
+                logger.error(f"Forward sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def run(self, bot):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [asyncio.create_task(self._worker(bot)) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(self._sweep()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+payment_forwarder = PaymentForwarder()
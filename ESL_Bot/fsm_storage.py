@@ -0,0 +1,421 @@
+"""
+FSM storage backends shared by all bot processes (Postgres or Redis) and a
+layer that turns the state/data writes of one update into a single write
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DEFAULT_DESTINY
+from aiogram.fsm.storage.memory import MemoryStorage
+from database import db
+from scheduler import scheduler
+from config import (FSM_STORAGE, FSM_STATE_TTL, FSM_REGISTRATION_TTL, FSM_PROMPT_TTL,
+                    FSM_SWEEP_INTERVAL, REDIS_URL, UPDATE_CONCURRENCY)
+
+logger = logging.getLogger(__name__)
+
+# Marks a field that was not read or written
+UNSET = object()
+
+# Seconds a conversation may stay in a state group (states.py) before it is dropped;
+# data saved outside any state lives FSM_STATE_TTL
+STATE_TTLS = {
+    'Registration': FSM_REGISTRATION_TTL,
+    'Payment': FSM_PROMPT_TTL,
+    'Question': FSM_PROMPT_TTL,
+    'Settings': FSM_PROMPT_TTL,
+}
+
+
+def state_name(state):
+    return state.state if isinstance(state, State) else state
+
+
+def state_ttl(state):
+    state = state_name(state)
+    if state is None:
+        return FSM_STATE_TTL
+    return STATE_TTLS.get(state.split(':', 1)[0], FSM_STATE_TTL)
+
+
+def storage_key(key):
+    """Flatten a StorageKey into one compact string"""
+    parts = ['fsm', str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(str(key.thread_id))
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(key.destiny)
+    return ':'.join(parts)
+
+
+class PostgresStorage(BaseStorage):
+    """One `fsm_states` row per conversation on the bot's asyncpg pool.
+
+    Rows expire `state_ttl` seconds after entering their state, or `ttl`
+    seconds after being created without one; expired rows are ignored on
+    read and deleted by `purge_expired`.
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL):
+        self.ttl = ttl
+
+    async def read(self, key):
+        """Return (state, data) in one query"""
+        async with db.pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                SELECT state, data FROM fsm_states
+                WHERE key = $1 AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+            ''', storage_key(key))
+        if row is None:
+            return None, {}
+        return row['state'], json.loads(row['data'])
+
+    async def write(self, key, state=UNSET, data=UNSET):
+        """Upsert the given fields in one statement; an empty conversation is deleted.
+
+        Entering a state restarts its TTL (`state_ttl`); writing only data keeps
+        the current deadline.
+        """
+        async with db.pool.acquire() as conn:
+            if state is None and data == {}:
+                await conn.execute('DELETE FROM fsm_states WHERE key = $1', storage_key(key))
+                return
+
+            columns, values = [], []
+            if state is not UNSET:
+                columns.append('state')
+                values.append(state_name(state))
+            if data is not UNSET:
+                columns.append('data')
+                values.append(json.dumps(data))
+            placeholders = [f"${i}" + ('::jsonb' if column == 'data' else '')
+                            for i, column in enumerate(columns, start=3)]
+            updates = [f"{column} = EXCLUDED.{column}" for column in columns]
+            if state is not UNSET:
+                updates.append('expires_at = EXCLUDED.expires_at')
+            ttl = self.ttl if state is UNSET else state_ttl(state)
+            await conn.execute(f'''
+                INSERT INTO fsm_states (key, {', '.join(columns)}, expires_at)
+                VALUES ($1, {', '.join(placeholders)}, CURRENT_TIMESTAMP + make_interval(secs => $2))
+                ON CONFLICT (key) DO UPDATE SET {', '.join(updates)}
+            ''', storage_key(key), ttl, *values)
+
+    async def set_state(self, key, state=None):
+        await self.write(key, state=state)
+
+    async def get_state(self, key):
+        return (await self.read(key))[0]
+
+    async def set_data(self, key, data):
+        await self.write(key, data=data)
+
+    async def get_data(self, key):
+        return (await self.read(key))[1]
+
+    async def purge_expired(self):
+        async with db.pool.acquire() as conn:
+            result = await conn.execute(
+                'DELETE FROM fsm_states WHERE expires_at <= CURRENT_TIMESTAMP')
+        logger.info(f"Purged expired FSM states: {result.split()[-1]}")
+
+    async def close(self):
+        # The pool belongs to `db`
+        pass
+
+
+class ExpiringStorage(BaseStorage):
+    """In-process storage (MemoryStorage) whose conversations expire per state.
+
+    Entering a state sets the conversation's deadline to now + `state_ttl`.
+    Deadlines live in a heap, so `sweep` pops only what is due: stale heap
+    entries left by later state changes are skipped, and the heap is rebuilt
+    once they outnumber the live ones. Cleared conversations are removed
+    from the underlying dict instead of being kept as empty records.
+    `sessions` and `bytes` gauge the live conversations and their JSON size.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or MemoryStorage()
+        self._deadlines = {}
+        self._sizes = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self.bytes = 0
+
+    @property
+    def sessions(self):
+        return len(self._sizes)
+
+    async def read(self, key):
+        if self._deadlines.get(key, float('inf')) <= time.monotonic():
+            self._forget(key)
+        # MemoryStorage.get_* would create an empty record for every reader
+        record = self.storage.storage.get(key)
+        if record is None:
+            return None, {}
+        return record.state, record.data.copy()
+
+    async def write(self, key, state=UNSET, data=UNSET):
+        if state is not UNSET:
+            await self.storage.set_state(key, state)
+        if data is not UNSET:
+            await self.storage.set_data(key, data)
+
+        record = self.storage.storage[key]
+        if record.state is None and not record.data:
+            self._forget(key)
+            return
+        if state is not UNSET or key not in self._deadlines:
+            deadline = time.monotonic() + state_ttl(record.state)
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), key))
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._heap = [(due, next(self._counter), k) for k, due in self._deadlines.items()]
+                heapq.heapify(self._heap)
+        size = len(json.dumps(record.data, default=str)) + len(record.state or '')
+        self.bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _forget(self, key):
+        self.storage.storage.pop(key, None)
+        self._deadlines.pop(key, None)
+        self.bytes -= self._sizes.pop(key, 0)
+
+    def sweep(self, now=None):
+        """Drop conversations past their deadline; returns how many were dropped"""
+        now = time.monotonic() if now is None else now
+        expired = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                self._forget(key)
+                expired += 1
+        return expired
+
+    async def run(self, interval=FSM_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.sweep()
+            if expired:
+                logger.info(f"Expired {expired} FSM sessions; live: {self.sessions} sessions, {self.bytes} bytes")
+
+    async def set_state(self, key, state=None):
+        await self.write(key, state=state)
+
+    async def get_state(self, key):
+        return (await self.read(key))[0]
+
+    async def set_data(self, key, data):
+        await self.write(key, data=data)
+
+    async def get_data(self, key):
+        return (await self.read(key))[1]
+
+    async def close(self):
+        await self.storage.close()
+
+
+class CoalescingStorage(BaseStorage):
+    """Buffer FSM writes made while handling one update and flush them together.
+
+    ChatEventIsolation opens `scope()` per update before aiogram reads the
+    state. Inside it the first access to a key reads state and data at once,
+    later reads are served from the buffer and writes only touch the buffer.
+    On exit each changed key is written once, so an update costs one read
+    and at most one write. Outside a scope calls go straight to the wrapped
+    storage.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._pending = ContextVar('fsm_pending', default=None)
+
+    @asynccontextmanager
+    async def scope(self):
+        token = self._pending.set({})
+        try:
+            yield
+        finally:
+            pending = self._pending.get()
+            self._pending.reset(token)
+            # Flush even if the handler failed, as direct writes would have happened too
+            await self.flush(pending)
+
+    async def flush(self, pending):
+        for key, entry in pending.items():
+            if not entry['dirty']:
+                continue
+            fields = {field: entry[field] for field in entry['dirty']}
+            try:
+                await self._write(key, **fields)
+            except Exception as e:
+                logger.error(f"Failed to save FSM state for {storage_key(key)}: {e}")
+
+    async def _read(self, key):
+        read = getattr(self.storage, 'read', None)
+        if read:
+            return await read(key)
+        return await self.storage.get_state(key), await self.storage.get_data(key)
+
+    async def _write(self, key, **fields):
+        write = getattr(self.storage, 'write', None)
+        if write:
+            await write(key, **fields)
+            return
+        if 'state' in fields:
+            await self.storage.set_state(key, fields['state'])
+        if 'data' in fields:
+            await self.storage.set_data(key, fields['data'])
+
+    async def _entry(self, key, pending, load=True):
+        entry = pending.setdefault(key, {'state': UNSET, 'data': UNSET, 'dirty': set()})
+        if load and (entry['state'] is UNSET or entry['data'] is UNSET):
+            state, data = await self._read(key)
+            if entry['state'] is UNSET:
+                entry['state'] = state
+            if entry['data'] is UNSET:
+                entry['data'] = data
+        return entry
+
+    async def set_state(self, key, state=None):
+        pending = self._pending.get()
+        if pending is None:
+            return await self.storage.set_state(key, state)
+        entry = await self._entry(key, pending, load=False)
+        entry['state'] = state_name(state)
+        entry['dirty'].add('state')
+
+    async def get_state(self, key):
+        pending = self._pending.get()
+        if pending is None:
+            return await self.storage.get_state(key)
+        return (await self._entry(key, pending))['state']
+
+    async def set_data(self, key, data):
+        pending = self._pending.get()
+        if pending is None:
+            return await self.storage.set_data(key, data)
+        entry = await self._entry(key, pending, load=False)
+        entry['data'] = dict(data)
+        entry['dirty'].add('data')
+
+    async def get_data(self, key):
+        pending = self._pending.get()
+        if pending is None:
+            return await self.storage.get_data(key)
+        return dict((await self._entry(key, pending))['data'])
+
+    async def close(self):
+        await self.storage.close()
+
+
+class ChatEventIsolation(BaseEventIsolation):
+    """Handle one update per chat at a time and at most `limit` updates overall.
+
+    aiogram's FSMContextMiddleware reads the state under this lock, so a
+    second quick tap is routed on the state the first one left behind.
+    Updates of a chat wait on that chat's lock in arrival order; different
+    chats only share the global semaphore, taken after the chat lock so
+    queued taps of one user hold no slots. A chat's lock is dropped as soon
+    as nothing holds or waits for it. `waiting` (queue depth) and `running`
+    are gauges.
+    """
+
+    def __init__(self, storage=None, limit=UPDATE_CONCURRENCY):
+        # A CoalescingStorage gets its per-update scope opened under the lock,
+        # so the state read by FSMContextMiddleware seeds the buffer and the
+        # buffered writes are flushed before the next update of the chat
+        self.storage = storage
+        self.limit = limit
+        self._slots = None
+        # (bot id, chat id) -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+        self.waiting = 0
+        self.running = 0
+
+    @property
+    def chats(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def lock(self, key):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        chat = (key.bot_id, key.chat_id)
+        entry = self._locks.setdefault(chat, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self.waiting += 1
+        started = False
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    self.waiting -= 1
+                    started = True
+                    self.running += 1
+                    try:
+                        async with self._scope():
+                            yield
+                    finally:
+                        self.running -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat]
+
+    def _scope(self):
+        scope = getattr(self.storage, 'scope', None)
+        return scope() if scope else _no_scope()
+
+    async def close(self):
+        self._locks.clear()
+
+
+@asynccontextmanager
+async def _no_scope():
+    yield
+
+
+def create_storage(backend=FSM_STORAGE):
+    """Build the FSM storage selected by FSM_STORAGE: postgres, redis or memory.
+
+    The redis backend needs the optional `redis` package and works with any
+    server speaking the Redis protocol, e.g. a local redis-server or valkey.
+    Only postgres and redis survive restarts and can be shared by several
+    bot processes.
+    """
+    if backend == 'postgres':
+        storage = PostgresStorage()
+    elif backend == 'redis':
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise RuntimeError("FSM_STORAGE=redis requires the 'redis' package")
+        storage = RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    elif backend == 'memory':
+        storage = ExpiringStorage()
+    else:
+        raise ValueError(f"Unknown FSM_STORAGE {backend!r}, expected postgres, redis or memory")
+    return CoalescingStorage(storage)
+
+
+def register_fsm_jobs(storage):
+    """Delete expired Postgres FSM rows every hour"""
+    backend = getattr(storage, 'storage', storage)
+    if isinstance(backend, PostgresStorage):
+        scheduler.add_job('fsm_purge', '0 * * * *', lambda due: backend.purge_expired(), catch_up='skip')
+
+
+async def sweep_fsm_sessions(storage):
+    """Expire in-process FSM sessions; every process sweeps its own memory"""
+    backend = getattr(storage, 'storage', storage)
+    if isinstance(backend, ExpiringStorage):
+        await backend.run()
@@ -1,21 +1,25 @@
 from aiogram import Bot
 from aiogram import Router, F
 from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
 from database import db
 from keyboards import *
 from texts import TEXTS
 from states import Registration, Payment, Question, Settings
+from filters import MenuButton
+from membership import is_channel_member, status_value
+from forwarder import payment_forwarder
+from outbox import outbox_worker
 import re
 
-from config import ADMIN_GROUP_ID
+from config import ADMIN_GROUP_ID, CHANNEL_USERNAME, SECRET_GROUP_LINK
 
 router = Router()
 
 
 @router.message(CommandStart())
-async def start_handler(message: Message, state: FSMContext):
+async def start_handler(message: Message, state: FSMContext, user):
     # Check for referral
     args = message.text.split()
     referrer_id = None
@@ -27,8 +31,10 @@ async def start_handler(message: Message, state: FSMContext):
 
     await state.update_data(referrer_id=referrer_id)
 
-    user = await db.get_user(message.from_user.id)
     if user:
+        # The user may be back after blocking the bot; include them in broadcasts again.
+        # The cached profile can predate a deactivation made by another process
+        await db.reactivate_user(message.from_user.id)
         lang = user['language']
         await message.answer(TEXTS[lang]['main_menu'], reply_markup=main_menu_keyboard(lang))
     else:
@@ -48,9 +54,14 @@ async def language_callback(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(Registration.subscription, F.data == 'continue_after_sub')
-async def after_subscription_callback(callback: CallbackQuery, state: FSMContext):
+async def after_subscription_callback(callback: CallbackQuery, state: FSMContext, bot: Bot):
     data = await state.get_data()
     lang = data['language']
+    # None means Telegram could not tell us; let the user through rather than block registration.
+    # Only a cached "member" is trusted here, a cached "left" may predate the join
+    if await is_channel_member(bot, callback.from_user.id, recheck_negative=True) is False:
+        await callback.answer(TEXTS[lang]['not_subscribed'], show_alert=True)
+        return
     await callback.message.edit_text(TEXTS[lang]['welcome'])
     await callback.message.answer(TEXTS[lang]['enter_name'])
     await state.set_state(Registration.name)
@@ -125,19 +136,19 @@ async def region_handler(message: Message, state: FSMContext):
 
 
 @router.message(
-    lambda message: message.text in [TEXTS['uz']['change_language'], TEXTS['ru']['change_language'], TEXTS['en']['change_language']],
+    MenuButton('change_language'),
     Registration.name
 )
 @router.message(
-    lambda message: message.text in [TEXTS['uz']['change_language'], TEXTS['ru']['change_language'], TEXTS['en']['change_language']],
+    MenuButton('change_language'),
     Registration.phone
 )
 @router.message(
-    lambda message: message.text in [TEXTS['uz']['change_language'], TEXTS['ru']['change_language'], TEXTS['en']['change_language']],
+    MenuButton('change_language'),
     Registration.age
 )
 @router.message(
-    lambda message: message.text in [TEXTS['uz']['change_language'], TEXTS['ru']['change_language'], TEXTS['en']['change_language']],
+    MenuButton('change_language'),
     Registration.region
 )
 async def change_language_registration_handler(message: Message, state: FSMContext):
@@ -176,60 +187,38 @@ async def process_change_language_registration_handler(callback: CallbackQuery,
 
 
 # Main menu handlers
-@router.message(F.text.in_([TEXTS['uz']['payment'], TEXTS['ru']['payment'], TEXTS['en']['payment']]))
-async def payment_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('payment'))
+async def payment_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
 
     await message.answer(TEXTS[lang]['payment_instruction'])
     await state.set_state(Payment.screenshot)
 
 
 @router.message(Payment.screenshot, F.photo)
-async def payment_screenshot_handler(message: Message, state: FSMContext):
-    print("DEBUG: payment_screenshot_handler triggered")
-    user = await db.get_user(message.from_user.id)
+async def payment_screenshot_handler(message: Message, state: FSMContext, user):
     lang = user['language']
 
     payment_id = await db.add_payment(message.from_user.id, message.photo[-1].file_id)
-    
-    await message.answer(TEXTS[lang]['payment_sent'], reply_markup=main_menu_keyboard(lang))
-    
-    # Send to admin group
-    from main import bot
 
-    admin_message = await bot.send_photo(
-        ADMIN_GROUP_ID,
-        message.photo[-1].file_id,
-        caption=f"🆔 {message.from_user.id}\n👤 {user['full_name']}\n📞 {user['phone']}\n📍 {user['region']}",
-        reply_markup=payment_admin_keyboard(payment_id)
-    )
-
-    # Update payment with admin message ID
-    async with db.pool.acquire() as conn:
-        await conn.execute(
-            'UPDATE payments SET admin_message_id = $1 WHERE id = $2',
-            admin_message.message_id, payment_id
-        )
+    # The admin group gets the screenshot from the background forwarder
+    payment_forwarder.submit(payment_id)
 
-    # Debug print for language and available keys
-    print(f"DEBUG: Sending payment success message. lang={lang}, available keys={list(TEXTS.keys())}")
+    await message.answer(TEXTS[lang]['payment_sent'], reply_markup=main_menu_keyboard(lang))
     await message.answer(TEXTS[lang]['payment_success'], reply_markup=main_menu_keyboard(lang))
     await state.clear()
 
 
-@router.message(F.text.in_([TEXTS['uz']['questions'], TEXTS['ru']['questions'], TEXTS['en']['questions']]))
-async def questions_handler(message: Message):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('questions'))
+async def questions_handler(message: Message, user, button_lang):
+    lang = button_lang or user['language']
 
     await message.answer(TEXTS[lang]['questions'], reply_markup=questions_keyboard(lang))
 
 
-@router.message(F.text.in_([TEXTS['uz']['faq'], TEXTS['ru']['faq'], TEXTS['en']['faq']]))
-async def faq_handler(message: Message):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('faq'))
+async def faq_handler(message: Message, user, button_lang):
+    lang = button_lang or user['language']
 
     faq_items = await db.get_faq(lang)
     if not faq_items:
@@ -243,24 +232,22 @@ async def faq_handler(message: Message):
     await message.answer(faq_text)
 
 
-@router.message(F.text.in_([TEXTS['uz']['ask_question'], TEXTS['ru']['ask_question'], TEXTS['en']['ask_question']]))
-async def ask_question_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('ask_question'))
+async def ask_question_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
 
     await message.answer(TEXTS[lang]['enter_question'])
     await state.set_state(Question.text)
 
 
 @router.message(Question.text)
-async def question_text_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def question_text_handler(message: Message, state: FSMContext, user):
     lang = user['language']
 
-    await db.add_question(message.from_user.id, message.text)
+    question_id = await db.add_question(message.from_user.id, message.text)
 
     # Send to admin group
-    from main import bot
+    bot = message.bot
 
     username = message.from_user.username
     full_name = user['full_name']
@@ -271,7 +258,8 @@ async def question_text_handler(message: Message, state: FSMContext):
 
     await bot.send_message(
         ADMIN_GROUP_ID,
-        f"📝 Yangi savol:\n<code>id:{message.from_user.id}</code>\n{user_line}\n💬 {message.text}",
+        f"📝 Yangi savol:\n<code>id:{message.from_user.id}</code> <code>savol:{question_id}</code>\n"
+        f"{user_line}\n💬 {message.text}",
         parse_mode="HTML"
     )
 
@@ -279,10 +267,9 @@ async def question_text_handler(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.message(F.text.in_([TEXTS['uz']['referral'], TEXTS['ru']['referral'], TEXTS['en']['referral']]))
-async def referral_handler(message: Message, bot: Bot):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('referral'))
+async def referral_handler(message: Message, bot: Bot, user, button_lang):
+    lang = button_lang or user['language']
 
     stats = await db.get_referral_stats(message.from_user.id)
     bot_info = await bot.get_me()
@@ -297,36 +284,32 @@ async def referral_handler(message: Message, bot: Bot):
     )
 
 
-@router.message(F.text.in_([TEXTS['uz']['main_menu'], TEXTS['ru']['main_menu'], TEXTS['en']['main_menu']]))
-async def main_menu_handler(message: Message):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('main_menu'))
+async def main_menu_handler(message: Message, user, button_lang):
+    lang = button_lang or user['language']
 
     await message.answer(TEXTS[lang]['main_menu'], reply_markup=main_menu_keyboard(lang))
 
 
-@router.message(F.text.in_([TEXTS['uz']['settings'], TEXTS['ru']['settings'], TEXTS['en']['settings']]))
-async def settings_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('settings'))
+async def settings_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
 
     await state.clear()
 
     await message.answer(TEXTS[lang]['settings'], reply_markup=settings_keyboard(lang))
 
 
-@router.message(F.text.in_([TEXTS['uz']['change_age'], TEXTS['ru']['change_age'], TEXTS['en']['change_age']]))
-async def change_age_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('change_age'))
+async def change_age_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
 
     await message.answer(TEXTS[lang]['enter_age'])
     await state.set_state(Settings.change_age)
 
 
 @router.message(Settings.change_age)
-async def process_change_age_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def process_change_age_handler(message: Message, state: FSMContext, user):
     lang = user['language']
 
     try:
@@ -339,63 +322,56 @@ async def process_change_age_handler(message: Message, state: FSMContext):
         return
 
 
-@router.message(F.text.in_([TEXTS['uz']['change_name'], TEXTS['ru']['change_name'], TEXTS['en']['change_name']]))
-async def change_name_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('change_name'))
+async def change_name_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
     await message.answer(TEXTS[lang]['enter_name'])
     await state.set_state(Settings.change_name)
 
 
 @router.message(Settings.change_name)
-async def process_change_name_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def process_change_name_handler(message: Message, state: FSMContext, user):
     lang = user['language']
     await db.update_user_name(message.from_user.id, message.text)
     await message.answer(TEXTS[lang]['changes_saved'], reply_markup=main_menu_keyboard(lang))
     await state.clear()
 
 
-@router.message(F.text.in_([TEXTS['uz']['change_number'], TEXTS['ru']['change_number'], TEXTS['en']['change_number']]))
-async def change_phone_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('change_number'))
+async def change_phone_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
     await message.answer(TEXTS[lang]['enter_phone'])
     await state.set_state(Settings.change_phone)
 
 
 @router.message(Settings.change_phone)
-async def process_change_phone_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def process_change_phone_handler(message: Message, state: FSMContext, user):
     lang = user['language']
     await db.update_user_phone(message.from_user.id, message.text)
     await message.answer(TEXTS[lang]['changes_saved'], reply_markup=main_menu_keyboard(lang))
     await state.clear()
 
 
-@router.message(F.text.in_([TEXTS['uz']['change_city'], TEXTS['ru']['change_city'], TEXTS['en']['change_city']]))
-async def change_region_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
-    lang = user['language']
+@router.message(MenuButton('change_city'))
+async def change_region_handler(message: Message, state: FSMContext, user, button_lang):
+    lang = button_lang or user['language']
     await message.answer(TEXTS[lang]['enter_region'], reply_markup=regions_keyboard(lang))
     await state.set_state(Settings.change_region)
 
 
 @router.message(Settings.change_region)
-async def process_change_region_handler(message: Message, state: FSMContext):
-    user = await db.get_user(message.from_user.id)
+async def process_change_region_handler(message: Message, state: FSMContext, user):
     lang = user['language']
     await db.update_user_region(message.from_user.id, message.text)
     await message.answer(TEXTS[lang]['changes_saved'], reply_markup=main_menu_keyboard(lang))
     await state.clear()
 
 
-@router.message(F.text.in_([TEXTS['uz']['change_language'], TEXTS['ru']['change_language'], TEXTS['en']['change_language']]))
-async def change_language_handler(message: Message, state: FSMContext):
+@router.message(MenuButton('change_language'))
+async def change_language_handler(message: Message, state: FSMContext, user, button_lang):
     current_state = await state.get_state()
     print(f'DEBUG: Settings change_language handler triggered, FSM state: {current_state}')
-    user = await db.get_user(message.from_user.id)
-    lang = user['language'] if user else 'uz'
+    lang = button_lang or (user['language'] if user else 'uz')
     await message.answer(TEXTS[lang]['choose_language'], reply_markup=language_keyboard())
     await state.set_state(Settings.change_language)
 
@@ -415,26 +391,25 @@ async def process_change_language_handler(callback: CallbackQuery, state: FSMCon
     await state.clear()
 
 
+@router.chat_member(F.chat.username == CHANNEL_USERNAME.lstrip('@'))
+async def channel_member_handler(update: ChatMemberUpdated):
+    await db.set_channel_membership(update.new_chat_member.user.id, status_value(update.new_chat_member.status))
+
+
 # Admin handlers
 @router.callback_query(F.data.startswith("approve_"))
 async def approve_payment(callback: CallbackQuery):
     payment_id = int(callback.data.split("_")[1])
 
-    await db.update_payment_status(payment_id, 'approved')
-
-    # Get user info
-    async with db.pool.acquire() as conn:
-        payment = await conn.fetchrow('SELECT user_id FROM payments WHERE id = $1', payment_id)
-        user = await db.get_user(payment['user_id'])
-
-    # Send group link to user
-    from main import bot
-    from config import SECRET_GROUP_LINK
-
-    await bot.send_message(
-        payment['user_id'],
-        TEXTS[user['language']]['payment_approved'] + f"\n{SECRET_GROUP_LINK}"
+    # The group link is queued in the outbox together with the approval
+    payment = await db.decide_payment(
+        payment_id, 'approved',
+        notify=lambda lang: TEXTS[lang]['payment_approved'] + f"\n{SECRET_GROUP_LINK}"
     )
+    if payment is None or not payment['decided']:
+        await callback.answer("⚠️ Bu to'lov allaqachon ko'rib chiqilgan!")
+        return
+    outbox_worker.wake()
 
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer("✅ To'lov tasdiqlandi!")
@@ -444,20 +419,14 @@ async def approve_payment(callback: CallbackQuery):
 async def reject_payment(callback: CallbackQuery):
     payment_id = int(callback.data.split("_")[1])
 
-    await db.update_payment_status(payment_id, 'rejected')
-
-    # Get user info
-    async with db.pool.acquire() as conn:
-        payment = await conn.fetchrow('SELECT user_id FROM payments WHERE id = $1', payment_id)
-        user = await db.get_user(payment['user_id'])
-
-    # Notify user
-    from main import bot
-
-    await bot.send_message(
-        payment['user_id'],
-        TEXTS[user['language']]['payment_rejected']
+    payment = await db.decide_payment(
+        payment_id, 'rejected',
+        notify=lambda lang: TEXTS[lang]['payment_rejected']
     )
+    if payment is None or not payment['decided']:
+        await callback.answer("⚠️ Bu to'lov allaqachon ko'rib chiqilgan!")
+        return
+    outbox_worker.wake()
 
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer("❌ To'lov rad etildi!")
@@ -474,27 +443,25 @@ async def admin_reply_to_user_question(message: Message):
         print("DEBUG: Not a reply, skipping.")
         return
     # Try to extract user ID from the original message (text or caption)
-    import re
     original_text = message.reply_to_message.text or message.reply_to_message.caption or ""
     match = re.search(r"id:(\d+)", original_text)
     if not match:
         print("DEBUG: Could not extract user ID from replied message.")
         return
     user_id = int(match.group(1))
-    from main import bot
-    # Send the admin's reply to the user (handle text, photo, document)
+    question = re.search(r"savol:(\d+)", original_text)
+    question_id = int(question.group(1)) if question else None
+    # Queue the admin's reply to the user (handle text, photo, document)
     if message.text:
-        await bot.send_message(user_id, f"{message.text}")
-        print(f"DEBUG: Sent text reply to user {user_id}")
+        method, payload = 'send_message', {'text': f"{message.text}"}
     elif message.photo:
-        await bot.send_photo(user_id, message.photo[-1].file_id, caption=f"{message.caption or ''}")
-        print(f"DEBUG: Sent photo reply to user {user_id}")
+        method, payload = 'send_photo', {'photo': message.photo[-1].file_id, 'caption': f"{message.caption or ''}"}
     elif message.document:
-        await bot.send_document(user_id, message.document.file_id, caption=f"{message.caption or ''}")
-        print(f"DEBUG: Sent document reply to user {user_id}")
+        method, payload = 'send_document', {'document': message.document.file_id, 'caption': f"{message.caption or ''}"}
     else:
-        await bot.send_message(user_id, "[Noma'lum fayl turi]")
-        print(f"DEBUG: Sent unknown file type reply to user {user_id}")
+        method, payload = 'send_message', {'text': "[Noma'lum fayl turi]"}
+    await db.answer_question(user_id, question_id, f"answer:{message.chat.id}:{message.message_id}", method, payload)
+    outbox_worker.wake()
 
 
 @router.message(F.photo)
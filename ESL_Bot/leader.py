@@ -0,0 +1,78 @@
+"""
+Leader election between bot replicas using a Postgres session advisory lock
+"""
+
+import asyncio
+import logging
+from database import db
+from config import LEADER_LOCK_ID, LEADER_RETRY_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """Run leader-only work (scheduler, broadcast resume) on exactly one replica.
+
+    The lock is held by a connection taken from `db.pool` for as long as this
+    replica leads. Postgres drops a session lock together with its connection,
+    so if the leader dies or loses the database another replica wins the lock
+    on its next attempt, at most `retry_interval` seconds later.
+    """
+
+    def __init__(self, lock_id=LEADER_LOCK_ID, retry_interval=LEADER_RETRY_INTERVAL):
+        self.lock_id = lock_id
+        self.retry_interval = retry_interval
+        self.is_leader = False
+
+    async def _try_lock(self, conn):
+        return await conn.fetchval('SELECT pg_try_advisory_lock($1)', self.lock_id)
+
+    async def _hold(self, conn):
+        """Return once the connection holding the lock stops answering"""
+        while True:
+            await asyncio.sleep(self.retry_interval)
+            try:
+                await asyncio.wait_for(conn.fetchval('SELECT 1'), timeout=self.retry_interval)
+            except Exception as e:
+                logger.error(f"Lost leader lock connection: {e}")
+                return
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Leader task failed: {task.exception()}")
+
+    async def run(self, *leader_jobs):
+        """Contend for leadership forever; `leader_jobs` are coroutine functions started on election"""
+        while True:
+            conn = None
+            try:
+                conn = await db.pool.acquire()
+                if await self._try_lock(conn):
+                    self.is_leader = True
+                    logger.info(f"Elected leader (advisory lock {self.lock_id})")
+                    tasks = [asyncio.create_task(job()) for job in leader_jobs]
+                    for task in tasks:
+                        task.add_done_callback(self._log_failure)
+                    try:
+                        await self._hold(conn)
+                    finally:
+                        self.is_leader = False
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                        logger.warning("Stepped down as leader")
+                    # Never hand a possibly broken lock connection back to the pool
+                    conn.terminate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Leader election error: {e}")
+            finally:
+                if conn is not None:
+                    await db.pool.release(conn)
+
+            await asyncio.sleep(self.retry_interval)
+
+
+leader = LeaderElection()
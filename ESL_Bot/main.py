@@ -1,59 +1,191 @@
 import asyncio
 import logging
+from aiohttp import web
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from config import BOT_TOKEN, BOT_MODE, WEB_HOST, WEB_PORT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, SHARD_WORKERS
 from database import db
 from handlers import router
-from notifications import schedule_notifications
-from flask import Flask
-from threading import Thread
-import os
+from middlewares import MenuButtonMiddleware, UserProfileMiddleware
+from fsm_storage import ChatEventIsolation, create_storage, register_fsm_jobs, sweep_fsm_sessions
+from notifications import register_notification_jobs, resume_broadcasts
+from discount_calculator import register_discount_jobs
+from scheduler import scheduler
+from leader import leader
+from forwarder import payment_forwarder
+from outbox import outbox_worker
+from sharding import ShardedReceiver
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+storage = create_storage()
+# One update per chat at a time, different chats in parallel up to UPDATE_CONCURRENCY;
+# FSMContextMiddleware loads the state after taking the chat's lock, inside the
+# storage's per-update scope, so an update costs one FSM read and at most one write
+isolation = ChatEventIsolation(storage)
+dp = Dispatcher(storage=storage, events_isolation=isolation)
 
-# Flask app
-web_app = Flask(__name__)
 
-@web_app.route("/healthy", methods=["GET"])
-def healthy():
-    return "<b>Bot is alive🎉🥳</b>", 200
+async def healthy(request):
+    """Liveness: the event loop is serving requests"""
+    return web.Response(text="<b>Bot is alive🎉🥳</b>", content_type="text/html")
+
+
+async def ready(request):
+    """Readiness: startup finished and the database answers"""
+    if not request.app['ready']:
+        return web.Response(status=503, text="starting")
+    receiver = request.app['receiver']
+    if receiver:
+        # The receiver has no database of its own; its workers do
+        if not receiver.alive():
+            return web.Response(status=503, text="worker process down")
+        return web.Response(text="ready")
+    try:
+        async with db.pool.acquire(timeout=2) as conn:
+            await conn.fetchval('SELECT 1')
+    except Exception as e:
+        logging.error(f"Readiness check failed: {e}")
+        return web.Response(status=503, text="database unavailable")
+    return web.Response(text="ready")
+
+
+async def stats(request):
+    """Load gauges of this process"""
+    backend = getattr(storage, 'storage', storage)
+    return web.json_response({
+        'updates_waiting': isolation.waiting,
+        'updates_running': isolation.running,
+        'locked_chats': isolation.chats,
+        'fsm_sessions': getattr(backend, 'sessions', None),
+        'fsm_bytes': getattr(backend, 'bytes', None),
+    })
+
+
+def create_web_app(receiver=None):
+    """One aiohttp app for health checks and, in webhook mode, Telegram updates"""
+    app = web.Application()
+    app['ready'] = False
+    app['receiver'] = receiver
+    app.router.add_get("/healthy", healthy)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/stats", stats)
+    if BOT_MODE == 'webhook':
+        if receiver:
+            app.router.add_post(WEBHOOK_PATH, receiver.handle_webhook)
+        else:
+            # Requests without Telegram's X-Telegram-Bot-Api-Secret-Token header are rejected
+            SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+            setup_application(app, dp, bot=bot)
+    return app
+
+
+async def start_webhook(app):
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_URL")
+    # chat_member updates are only delivered when requested explicitly
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    app['ready'] = True
+    logging.info(f"Receiving updates by webhook on {WEBHOOK_PATH}")
+    await asyncio.Event().wait()
+
+
+async def start_polling(app):
+    # A webhook left from webhook mode would make getUpdates fail
+    await bot.delete_webhook()
+    app['ready'] = True
+    # chat_member updates are only delivered when requested explicitly
+    if app['receiver']:
+        await app['receiver'].poll(bot, dp.resolve_used_update_types())
+    else:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+
+
+def setup_dispatcher():
+    # Resolve the user's profile once per update before any handler runs
+    dp.message.outer_middleware(UserProfileMiddleware())
+    dp.callback_query.outer_middleware(UserProfileMiddleware())
+    dp.message.outer_middleware(MenuButtonMiddleware())
+
+    # Register handlers
+    dp.include_router(router)
+
+
+async def startup():
+    """Prepare this process to handle updates; also run by every sharded worker"""
+    # Initialize database
+    await db.create_pool()
+    await db.init_db()
+
+    setup_dispatcher()
+
+    # Bound in-process FSM memory by dropping abandoned sessions
+    asyncio.create_task(sweep_fsm_sessions(storage))
+
+    # Forward payment screenshots to the admin group in background
+    asyncio.create_task(payment_forwarder.run(bot))
+
+    # Deliver user notifications queued in the outbox
+    asyncio.create_task(outbox_worker.run(bot))
+
+    # Only the replica holding the leader lock runs the scheduler and
+    # finishes broadcasts interrupted by the previous shutdown
+    register_notification_jobs(bot)
+    register_discount_jobs(bot)
+    register_fsm_jobs(storage)
+    asyncio.create_task(leader.run(scheduler.run, lambda: resume_broadcasts(bot)))
+
+
+async def stop_background_tasks():
+    """Cancel the loops started by startup(); the leader keeps a connection
+    checked out, which would otherwise hold up closing the pool"""
+    background = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
 
-def run_flask():
-    # Optional: You can dynamically use PORT from environment if needed
-    port = int(os.environ.get("PORT", 5000))
-    web_app.run(host="0.0.0.0", port=port)
 
 async def main():
     """Main function to run the bot"""
+    runner = None
+    receiver = None
     try:
-        # Initialize database
-        await db.create_pool()
-        await db.init_db()
-
-        # Register handlers
-        dp.include_router(router)
+        if SHARD_WORKERS > 1:
+            # This process only receives updates; handlers run in the workers
+            setup_dispatcher()
+            receiver = ShardedReceiver(SHARD_WORKERS)
+            receiver.start()
+        else:
+            await startup()
 
-        # Start notification scheduler in background
-        asyncio.create_task(schedule_notifications(bot))
+        # Health checks are served in both modes, webhook updates on the same server
+        app = create_web_app(receiver)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
 
-        # Start polling
-        await dp.start_polling(bot)
+        if BOT_MODE == 'webhook':
+            await start_webhook(app)
+        else:
+            await start_polling(app)
 
     except Exception as e:
         logging.error(f"Error starting bot: {e}")
     finally:
+        if runner:
+            await runner.cleanup()
+        if receiver:
+            receiver.stop()
+            await bot.session.close()
+        await stop_background_tasks()
         await db.close_pool()
 
 if __name__ == "__main__":
-    # Start Flask in a separate thread
-    flask_thread = Thread(target=run_flask)
-    flask_thread.start()
-
-    # Run the Telegram bot
     asyncio.run(main())
@@ -0,0 +1,48 @@
+"""
+Channel membership lookups backed by the channel_members table
+"""
+
+import logging
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from database import db
+from config import CHANNEL_USERNAME, CHANNEL_MEMBERSHIP_TTL
+
+logger = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+
+def status_value(status):
+    """ChatMemberStatus enum or plain string -> plain string"""
+    return getattr(status, 'value', status)
+
+
+async def is_channel_member(bot, telegram_id, recheck_negative=False, before_call=None):
+    """Return True/False, or None when Telegram could not tell us.
+
+    Entries kept fresh by chat_member updates are answered from the database;
+    only unknown or stale users cost a get_chat_member call. With
+    `recheck_negative` a cached "not a member" is confirmed with Telegram too,
+    since a missed chat_member update must not keep someone who just joined
+    out. `before_call` is awaited before the API call (e.g. a rate limiter).
+    """
+    status = await db.get_channel_membership(telegram_id, CHANNEL_MEMBERSHIP_TTL)
+    if status is None or (recheck_negative and status not in MEMBER_STATUSES):
+        if before_call:
+            await before_call()
+        try:
+            member = await bot.get_chat_member(CHANNEL_USERNAME, telegram_id)
+            status = status_value(member.status)
+        except TelegramBadRequest as e:
+            description = str(e).lower()
+            if "user not found" not in description and "user is not a member" not in description:
+                logger.warning(f"Could not check channel membership of {telegram_id}: {e}")
+                return None
+            status = 'left'
+        except TelegramRetryAfter:
+            raise
+        except TelegramAPIError as e:
+            logger.warning(f"Could not check channel membership of {telegram_id}: {e}")
+            return None
+        await db.set_channel_membership(telegram_id, status)
+    return status in MEMBER_STATUSES
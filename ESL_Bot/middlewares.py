@@ -0,0 +1,35 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database import db
+from texts import BUTTON_INDEX
+
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Resolve the sender's profile once per update and pass it to handlers as `user`"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get('event_from_user')
+        data['user'] = await db.get_user(from_user.id) if from_user else None
+        return await handler(event, data)
+
+
+class MenuButtonMiddleware(BaseMiddleware):
+    """Look up the pressed menu button once per message for the MenuButton filter"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        data['menu_button'] = BUTTON_INDEX.get(getattr(event, 'text', None))
+        return await handler(event, data)
+
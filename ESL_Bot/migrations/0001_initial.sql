@@ -0,0 +1,80 @@
+-- Tables that existed before versioned migrations; IF NOT EXISTS keeps this safe on old databases
+
+-- Users table
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    full_name VARCHAR(255) NOT NULL,
+    phone VARCHAR(20),
+    age INTEGER,
+    region VARCHAR(100),
+    language VARCHAR(10) DEFAULT 'uz',
+    referrer_id BIGINT,
+    referral_count INTEGER DEFAULT 0,
+    payment_status BOOLEAN DEFAULT FALSE,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Payments table
+CREATE TABLE IF NOT EXISTS payments (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    screenshot_file_id VARCHAR(255),
+    status VARCHAR(20) DEFAULT 'pending',
+    admin_message_id INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(telegram_id)
+);
+
+-- Questions table
+CREATE TABLE IF NOT EXISTS questions (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    question TEXT NOT NULL,
+    answered BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(telegram_id)
+);
+
+-- FAQ table
+CREATE TABLE IF NOT EXISTS faq (
+    id SERIAL PRIMARY KEY,
+    question_uz TEXT,
+    answer_uz TEXT,
+    question_ru TEXT,
+    answer_ru TEXT,
+    question_en TEXT,
+    answer_en TEXT
+);
+
+-- Broadcast jobs and per-recipient delivery checkpoints
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id SERIAL PRIMARY KEY,
+    job_key VARCHAR(255) UNIQUE NOT NULL,
+    name VARCHAR(100) NOT NULL,
+    status VARCHAR(20) DEFAULT 'running',
+    total INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    skipped INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    telegram_id BIGINT NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    error TEXT,
+    delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (job_id, telegram_id)
+);
+
+-- Channel membership, kept fresh from chat_member updates
+CREATE TABLE IF NOT EXISTS channel_members (
+    telegram_id BIGINT PRIMARY KEY,
+    status VARCHAR(20) NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,15 @@
+-- Referral lookups: get_referral_stats and the referral/discount self-joins
+CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users (referrer_id);
+CREATE INDEX IF NOT EXISTS idx_users_referrer_paid ON users (referrer_id) WHERE payment_status;
+
+-- Broadcast audience of get_users_for_notification
+CREATE INDEX IF NOT EXISTS idx_users_paid_active ON users (payment_status, is_active);
+CREATE INDEX IF NOT EXISTS idx_users_notification_audience ON users (telegram_id) INCLUDE (language)
+    WHERE payment_status AND is_active;
+
+-- Payments by user and by status; the admin pending queue is ordered by created_at
+CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id);
+CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status);
+CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments (created_at) WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_questions_user_id ON questions (user_id);
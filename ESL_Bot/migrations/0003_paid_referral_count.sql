@@ -0,0 +1,18 @@
+-- Paid referrals per referrer, maintained by Database._set_payment_status
+ALTER TABLE users ADD COLUMN IF NOT EXISTS paid_referral_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE users u
+SET paid_referral_count = r.paid
+FROM (
+    SELECT referrer_id, COUNT(*) AS paid
+    FROM users
+    WHERE referrer_id IS NOT NULL AND payment_status = TRUE
+    GROUP BY referrer_id
+) r
+WHERE u.telegram_id = r.referrer_id;
+
+-- Monthly discount audience and the admin referral leaderboard
+CREATE INDEX IF NOT EXISTS idx_users_discount_audience ON users (telegram_id)
+    WHERE payment_status AND paid_referral_count > 0;
+CREATE INDEX IF NOT EXISTS idx_users_referral_count ON users (referral_count DESC)
+    WHERE referral_count > 0;
@@ -0,0 +1,14 @@
+-- Forwarding of payment screenshots to the admin group by forwarder.PaymentForwarder.
+-- forward_status: pending -> forwarded, or failed after the last retry.
+-- next_forward_at doubles as a lease so only one worker sends a given payment.
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS forward_status VARCHAR(20);
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS forward_attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS next_forward_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- Payments made before this migration were forwarded synchronously
+UPDATE payments SET forward_status = 'forwarded' WHERE forward_status IS NULL;
+ALTER TABLE payments ALTER COLUMN forward_status SET DEFAULT 'pending';
+ALTER TABLE payments ALTER COLUMN forward_status SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_payments_forward_due ON payments (next_forward_at)
+    WHERE forward_status = 'pending';
@@ -0,0 +1,19 @@
+-- Transactional outbox: user notifications written together with the state change
+-- that causes them and delivered by outbox.OutboxWorker
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    dedup_key VARCHAR(255) UNIQUE NOT NULL,
+    chat_id BIGINT NOT NULL,
+    method VARCHAR(20) NOT NULL DEFAULT 'send_message',
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    delivered_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_questions_unanswered ON questions (user_id, created_at) WHERE NOT answered;
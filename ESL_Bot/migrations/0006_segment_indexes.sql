@@ -0,0 +1,5 @@
+-- Filters used by segments.Segment
+CREATE INDEX IF NOT EXISTS idx_users_language_region ON users (language, region) WHERE is_active;
+CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at);
+CREATE INDEX IF NOT EXISTS idx_users_age ON users (age) WHERE age IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_channel_members_status ON channel_members (status);
@@ -0,0 +1,43 @@
+-- Row modification times for incremental exports (AdminPanel.export_changes)
+CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+ALTER TABLE questions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+
+UPDATE users SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+UPDATE payments SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+UPDATE questions SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+
+ALTER TABLE users ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE users ALTER COLUMN updated_at SET NOT NULL;
+ALTER TABLE payments ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE payments ALTER COLUMN updated_at SET NOT NULL;
+ALTER TABLE questions ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE questions ALTER COLUMN updated_at SET NOT NULL;
+
+DROP TRIGGER IF EXISTS users_set_updated_at ON users;
+CREATE TRIGGER users_set_updated_at BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+DROP TRIGGER IF EXISTS payments_set_updated_at ON payments;
+CREATE TRIGGER payments_set_updated_at BEFORE UPDATE ON payments
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+DROP TRIGGER IF EXISTS questions_set_updated_at ON questions;
+CREATE TRIGGER questions_set_updated_at BEFORE UPDATE ON questions
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users (updated_at);
+CREATE INDEX IF NOT EXISTS idx_payments_updated_at ON payments (updated_at);
+CREATE INDEX IF NOT EXISTS idx_questions_updated_at ON questions (updated_at);
+
+-- Last exported updated_at per consumer and table
+CREATE TABLE IF NOT EXISTS export_watermarks (
+    name VARCHAR(100) PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,82 @@
+-- Rollups read by the admin statistics (AdminPanel), kept current by triggers
+-- in the same transaction as the change so they never drift from the source rows.
+-- Referrals per referrer are already rolled up in users.referral_count and
+-- users.paid_referral_count (see 0003).
+
+-- Signups per calendar day
+CREATE TABLE IF NOT EXISTS signup_daily (
+    day DATE PRIMARY KEY,
+    signups INTEGER NOT NULL DEFAULT 0
+);
+
+-- Payments per status
+CREATE TABLE IF NOT EXISTS payment_status_counts (
+    status VARCHAR(20) PRIMARY KEY,
+    total INTEGER NOT NULL DEFAULT 0
+);
+
+-- Payment attempts per user, replaces the users/payments join in the user list
+ALTER TABLE users ADD COLUMN IF NOT EXISTS payment_attempts INTEGER NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION rollup_users() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO signup_daily (day, signups)
+        VALUES (COALESCE(NEW.created_at, CURRENT_TIMESTAMP)::date, 1)
+        ON CONFLICT (day) DO UPDATE SET signups = signup_daily.signups + 1;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE signup_daily SET signups = signups - 1
+        WHERE day = COALESCE(OLD.created_at, CURRENT_TIMESTAMP)::date;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rollup_payments() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE payment_status_counts SET total = total - 1
+        WHERE status = COALESCE(OLD.status, 'pending');
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO payment_status_counts (status, total)
+        VALUES (COALESCE(NEW.status, 'pending'), 1)
+        ON CONFLICT (status) DO UPDATE SET total = payment_status_counts.total + 1;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET payment_attempts = payment_attempts + 1 WHERE telegram_id = NEW.user_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE users SET payment_attempts = payment_attempts - 1 WHERE telegram_id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_rollup ON users;
+CREATE TRIGGER users_rollup AFTER INSERT OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION rollup_users();
+DROP TRIGGER IF EXISTS payments_rollup ON payments;
+CREATE TRIGGER payments_rollup AFTER INSERT OR DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION rollup_payments();
+DROP TRIGGER IF EXISTS payments_status_rollup ON payments;
+CREATE TRIGGER payments_status_rollup AFTER UPDATE OF status ON payments
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION rollup_payments();
+
+-- Backfill from the existing rows
+TRUNCATE signup_daily, payment_status_counts;
+
+INSERT INTO signup_daily (day, signups)
+SELECT COALESCE(created_at, CURRENT_TIMESTAMP)::date, COUNT(*)
+FROM users
+GROUP BY 1;
+
+INSERT INTO payment_status_counts (status, total)
+SELECT COALESCE(status, 'pending'), COUNT(*)
+FROM payments
+GROUP BY 1;
+
+UPDATE users u
+SET payment_attempts = p.attempts
+FROM (SELECT user_id, COUNT(*) AS attempts FROM payments GROUP BY user_id) p
+WHERE u.telegram_id = p.user_id;
@@ -0,0 +1,14 @@
+-- Admin user browsing: keyset pages and fuzzy search (AdminPanel.list_users / search_users)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Newest-first pages on (created_at, telegram_id); telegram_id breaks ties.
+-- A NULL created_at would fall out of the keyset comparison, so forbid it
+UPDATE users SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_users_created_at_telegram_id ON users (created_at, telegram_id);
+
+-- Serve both similarity (%) and substring (ILIKE) matches on names
+CREATE INDEX IF NOT EXISTS idx_users_full_name_trgm ON users USING GIN (full_name gin_trgm_ops);
+-- Phones are stored as typed ("+998 90 123-45-67"), so they are searched by their digits
+CREATE INDEX IF NOT EXISTS idx_users_phone_digits_trgm ON users
+    USING GIN (regexp_replace(phone, '\D', '', 'g') gin_trgm_ops);
@@ -0,0 +1,10 @@
+-- FSM state shared by all bot processes (fsm_storage.PostgresStorage)
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key VARCHAR(128) PRIMARY KEY,
+    state VARCHAR(100),
+    data JSONB NOT NULL DEFAULT '{}',
+    expires_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at)
+    WHERE expires_at IS NOT NULL;
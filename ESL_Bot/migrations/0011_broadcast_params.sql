@@ -0,0 +1,4 @@
+-- What a one-off broadcast was started with (e.g. a segment and its texts).
+-- The admin panel inserts such jobs with status 'queued'; the leader claims
+-- and sends them, and resume_broadcasts rebuilds them after a restart
+ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS params JSONB;
@@ -0,0 +1,71 @@
+"""
+Versioned schema migrations.
+
+Each `NNNN_description.sql` file in this package is applied once, in order,
+inside its own transaction, and recorded in the schema_version table.
+"""
+
+import logging
+import re
+from pathlib import Path
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+# Serializes replicas that start at the same time
+MIGRATION_LOCK_ID = 530175
+
+
+def load_migrations():
+    """Return [(version, name, sql)] sorted by version"""
+    migrations = []
+    for path in MIGRATIONS_DIR.iterdir():
+        match = MIGRATION_FILE.match(path.name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), path.read_text(encoding='utf-8')))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+    return migrations
+
+
+async def current_version(conn):
+    try:
+        return await conn.fetchval('SELECT MAX(version) FROM schema_version') or 0
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def migrate(pool):
+    """Bring the schema up to date; a no-op costing one query when it already is"""
+    migrations = load_migrations()
+    latest = migrations[-1][0] if migrations else 0
+
+    async with pool.acquire() as conn:
+        if await current_version(conn) >= latest:
+            return
+
+        await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+        try:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Another replica may have migrated while we waited for the lock
+            applied = await current_version(conn)
+            for version, name, sql in migrations:
+                if version <= applied:
+                    continue
+                logger.info(f"Applying migration {version:04d}_{name}")
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute(
+                        'INSERT INTO schema_version (version, name) VALUES ($1, $2)', version, name)
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
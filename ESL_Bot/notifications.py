@@ -1,85 +1,448 @@
 import asyncio
-from datetime import datetime, timedelta
+import logging
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
 from database import db
+from scheduler import scheduler
 from texts import TEXTS
-from aiogram.exceptions import TelegramAPIError
+from keyboards import continue_keyboard, subscription_keyboard
+from membership import is_channel_member
+from segments import Segment
+from config import (BROADCAST_RATE, BROADCAST_WORKERS, BROADCAST_CHAT_INTERVAL,
+                    BROADCAST_RESUME_HOURS, BROADCAST_CHECKPOINT_BATCH, CHANNEL_MEMBERSHIP_TTL)
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
+logger = logging.getLogger(__name__)
 
-async def send_lesson_notifications(bot):
-    """Send lesson notifications to all paid users"""
-    users = await db.get_users_for_notification()
 
-    for user in users:
-        try:
-            message = "🔔 Bugun soat 18:00 da ESL darsi bo'lib o'tadi! Zoom linkni tekshiring!"
-            if user['language'] == 'ru':
-                message = "🔔 Сегодня в 18:00 урок ESL! Проверьте ссылку Zoom!"
-            elif user['language'] == 'en':
-                message = "🔔 Today at 18:00 ESL lesson! Check the Zoom link!"
+class TokenBucket:
+    """Global send budget shared by every broadcast in the process"""
 
-            await bot.send_message(user['telegram_id'], message)
-            await asyncio.sleep(0.1)  # Rate limiting
-        except Exception as e:
-            print(f"Failed to send notification to {user['telegram_id']}: {e}")
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
 
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (used on flood-control errors)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
 
-async def schedule_notifications(bot):
-    """Schedule notifications for 6 and 12 hours before lesson"""
-    while True:
-        now = datetime.now()
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+bucket = TokenBucket(BROADCAST_RATE)
+
+
+# Failures after which the chat will never accept messages from the bot again
+PERMANENT_FAILURES = frozenset({'forbidden', 'chat_not_found', 'deactivated'})
+
+
+def classify_failure(error):
+    """Return 'forbidden', 'chat_not_found', 'deactivated' or 'transient' for a send error"""
+    description = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        if 'deactivated' in description:
+            return 'deactivated'
+        return 'forbidden'
+    if isinstance(error, TelegramBadRequest) and 'chat not found' in description:
+        return 'chat_not_found'
+    return 'transient'
+
+
+class DeactivationQueue:
+    """Collect unreachable chats during a broadcast and mark them inactive in batches"""
+
+    def __init__(self, batch_size=BROADCAST_CHECKPOINT_BATCH):
+        self.batch_size = batch_size
+        self._pending = set()
+        self._lock = None
+
+    async def add(self, telegram_id):
+        self._pending.add(telegram_id)
+        if len(self._pending) >= self.batch_size:
+            try:
+                await self.flush()
+            except Exception as e:
+                # The ids stay queued and go out with the next flush
+                logger.error(f"Failed to deactivate {len(self._pending)} users: {e}")
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            batch = set(self._pending)
+            if batch:
+                await db.deactivate_users(list(batch))
+                # Ids added while the write was in flight stay for the next batch
+                self._pending -= batch
+                logger.info(f"Deactivated {len(batch)} unreachable users")
+
+
+deactivation_queue = DeactivationQueue()
+
+
+@dataclass
+class BroadcastStats:
+    name: str
+    job_id: int = None
+    total: int = 0
+    sent: int = 0
+    skipped: int = 0
+    failed: int = 0
+    failures: Counter = field(default_factory=Counter)
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        failures = ', '.join(f"{kind}={count}" for kind, count in self.failures.items())
+        return (f"{self.name}: {self.sent} sent, {self.skipped} skipped, {self.failed} failed "
+                f"{'(' + failures + ') ' if failures else ''}"
+                f"of {self.total} in {self.elapsed:.1f}s ({self.rate:.1f} msg/s)")
+
+
+async def _iterate(recipients):
+    if hasattr(recipients, '__aiter__'):
+        async for recipient in recipients:
+            yield recipient
+    else:
+        for recipient in recipients:
+            yield recipient
+
+
+class DeliveryJournal:
+    """Buffer per-recipient results of a broadcast job and checkpoint them in batches"""
+
+    def __init__(self, job_id, batch_size=BROADCAST_CHECKPOINT_BATCH):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = asyncio.Lock()
+
+    @property
+    def full(self):
+        return len(self._pending) >= self.batch_size
+
+    def add(self, telegram_id, status, error=None):
+        self._pending.append((telegram_id, status, error))
+
+    async def flush(self):
+        async with self._lock:
+            batch = self._pending[:]
+            if batch:
+                await db.record_broadcast_deliveries(self.job_id, batch)
+                # Only drop what was written; workers keep appending meanwhile
+                del self._pending[:len(batch)]
+
+
+class Broadcaster:
+    """Send one message per recipient through a bounded pool of concurrent workers.
+
+    Every API call takes a token from the shared bucket, messages to the same
+    chat are spaced by `chat_interval`, and TelegramRetryAfter pauses the whole
+    bucket before the recipient is retried. Chats that blocked the bot or no
+    longer exist are queued for deactivation so later audiences exclude them.
+
+    When a `job_key` is given the run is journaled in broadcast_jobs: recipients
+    already recorded for that job are skipped, so rerunning the same key after a
+    crash resumes from the last checkpoint instead of sending twice.
+    """
+
+    def __init__(self, workers=BROADCAST_WORKERS, chat_interval=BROADCAST_CHAT_INTERVAL,
+                 max_attempts=3, progress_every=500):
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.progress_every = progress_every
+        # Shared by concurrent runs so two broadcasts to one chat are paced too;
+        # ordered by send time so entries older than chat_interval can be dropped
+        self._chat_last_sent = OrderedDict()
+        self._active_jobs = set()
+
+    async def _pace_chat(self, chat_id):
+        last_sent = self._chat_last_sent.get(chat_id)
+        if last_sent is not None:
+            wait = last_sent + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        now = time.monotonic()
+        self._chat_last_sent[chat_id] = now
+        self._chat_last_sent.move_to_end(chat_id)
+        # Entries past the interval no longer delay anything
+        while next(iter(self._chat_last_sent.values())) < now - self.chat_interval:
+            self._chat_last_sent.popitem(last=False)
 
-        # Check if it's time for 12-hour notification (6:00 AM)
-        if now.hour == 6 and now.minute == 0:
-            await send_lesson_notifications(bot)
+    async def _deliver(self, recipient, send, stats):
+        """Send to one recipient and return (status, error)"""
+        chat_id = recipient['telegram_id']
+        for attempt in range(1, self.max_attempts + 1):
+            await self._pace_chat(chat_id)
+            await bucket.acquire()
+            try:
+                delivered = await send(recipient)
+            except TelegramRetryAfter as e:
+                logger.warning(f"{stats.name}: flood control, pausing for {e.retry_after}s")
+                bucket.pause(e.retry_after)
+                continue
+            except Exception as e:
+                kind = classify_failure(e)
+                stats.failed += 1
+                stats.failures[kind] += 1
+                if kind in PERMANENT_FAILURES:
+                    await deactivation_queue.add(chat_id)
+                else:
+                    logger.info(f"{stats.name}: failed to send to {chat_id}: {e}")
+                return 'failed', kind
+            if delivered is False:
+                stats.skipped += 1
+                return 'skipped', None
+            stats.sent += 1
+            return 'sent', None
+        stats.failed += 1
+        stats.failures['transient'] += 1
+        return 'failed', 'transient'
 
-        # Check if it's time for 6-hour notification (12:00 PM)
-        if now.hour == 12 and now.minute == 0:
-            await send_lesson_notifications(bot)
+    async def _worker(self, queue, send, stats, journal, on_progress):
+        """Deliver until the end-of-queue marker. A failed checkpoint write is
+        raised, which fails the whole run; anything else is logged and skipped"""
+        while True:
+            recipient = await queue.get()
+            try:
+                if recipient is None:
+                    return
+                try:
+                    status, error = await self._deliver(recipient, send, stats)
+                except Exception as e:
+                    # Not journaled, so a resumed job tries this recipient again
+                    logger.exception(f"{stats.name}: error delivering to {recipient['telegram_id']}: {e}")
+                    continue
+                # Transient failures stay out of the journal so a resumed job retries them
+                if journal and error != 'transient':
+                    journal.add(recipient['telegram_id'], status, error)
+                    if journal.full:
+                        await journal.flush()
+                done = stats.sent + stats.skipped + stats.failed
+                if done % self.progress_every == 0:
+                    logger.info(f"Progress {stats}")
+                    if on_progress:
+                        try:
+                            await on_progress(stats)
+                        except Exception as e:
+                            logger.error(f"{stats.name}: progress callback failed: {e}")
+            finally:
+                queue.task_done()
 
-        # Sleep for 1 minute
-        await asyncio.sleep(60)
+    async def _produce(self, recipients, queue, stats, already_delivered):
+        async for recipient in _iterate(recipients):
+            if recipient['telegram_id'] in already_delivered:
+                continue
+            stats.total += 1
+            await queue.put(recipient)
+        for _ in range(self.workers):
+            await queue.put(None)
 
+    async def run(self, recipients, send, name='broadcast', on_progress=None, job_key=None, params=None):
+        """Call `send(recipient)` for every recipient; return False from it to mark a skip.
 
-async def send_subscription_to_all(bot):
-    users = await db.get_all_users()
-    for user in users:
+        `recipients` may be a list or an async iterator such as db.iter_all_users();
+        the queue is bounded, so paging only runs as far ahead as the workers.
+        `params` is stored with the job for broadcasts that resume_broadcasts
+        cannot rebuild from the name alone.
+
+        Returns the run's BroadcastStats, or None if the job was already finished.
+        """
+        if job_key in self._active_jobs:
+            # Startup resume and a scheduler catch-up run can ask for the same slot
+            logger.info(f"{name}: job {job_key} is already running in this process")
+            return None
+        self._active_jobs.add(job_key)
         try:
-            lang = user['language'] if user['language'] in TEXTS else 'uz'
-            await bot.send_message(
-                user['telegram_id'],
-                TEXTS[lang]['subscription_required'],
-                reply_markup=continue_keyboard(lang)
-            )
-            await asyncio.sleep(0.1)  # Rate limiting
-        except Exception as e:
-            print(f"Failed to send subscription message to {user['telegram_id']}: {e}")
-
-
-CHANNEL_USERNAME = "@ESL_Proficiency"
-
-async def send_subscription_to_unsubscribed(bot):
-    users = await db.get_all_users()
-    for user in users:
+            return await self._run(recipients, send, name, on_progress, job_key, params)
+        finally:
+            self._active_jobs.discard(job_key)
+
+    async def _run(self, recipients, send, name, on_progress, job_key, params):
+        journal = None
+        already_delivered = set()
+        if job_key:
+            job = await db.start_broadcast_job(job_key, name, params)
+            if job['status'] != 'running':
+                logger.info(f"{name}: job {job_key} is already {job['status']}, not sending again")
+                return None
+            journal = DeliveryJournal(job['id'])
+            already_delivered = await db.get_delivered_recipients(job['id'])
+            if already_delivered:
+                logger.info(f"{name}: resuming job {job_key}, {len(already_delivered)} recipients done")
+
+        stats = BroadcastStats(name, job_id=journal.job_id if journal else None)
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        tasks = [asyncio.create_task(self._produce(recipients, queue, stats, already_delivered))]
+        tasks += [asyncio.create_task(self._worker(queue, send, stats, journal, on_progress))
+                  for _ in range(self.workers)]
         try:
-            lang = user['language'] if user['language'] in TEXTS else 'uz'
-            member = await bot.get_chat_member(CHANNEL_USERNAME, user['telegram_id'])
-            if member.status not in ("member", "administrator", "creator"):
-                await bot.send_message(
-                    user['telegram_id'],
-                    TEXTS[lang]['subscription_required'],
-                    reply_markup=subscription_keyboard(lang)
-                )
-                await asyncio.sleep(0.1)  # Rate limiting
-        except TelegramAPIError as e:
-            # If user is not a participant, send the message
-            if "user not found" in str(e).lower() or "user is not a member" in str(e).lower():
-                await bot.send_message(
-                    user['telegram_id'],
-                    TEXTS[lang]['subscription_required'],
-                    reply_markup=subscription_keyboard(lang)
-                )
-                await asyncio.sleep(0.1)
-            else:
-                print(f"Failed to check/send to {user['telegram_id']}: {e}")
-        except Exception as e:
-            print(f"Failed to process {user['telegram_id']}: {e}")
+            # A worker that dies on a checkpoint write must not leave the producer
+            # blocked on the full queue; the job stays 'running' for resume_broadcasts
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception():
+                    logger.error(f"{name}: stopping {job_key or 'broadcast'} after {stats}")
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await deactivation_queue.flush()
+            except Exception as e:
+                logger.error(f"Failed to deactivate unreachable users: {e}")
+            if journal:
+                await journal.flush()
+
+        if journal:
+            await db.finish_broadcast_job(journal.job_id, 'completed', stats.total + len(already_delivered))
+        logger.info(f"Finished {stats}")
+        return stats
+
+
+broadcaster = Broadcaster()
+
+
+async def send_lesson_notifications(bot, job_key=None, due=None):
+    """Send lesson notifications to all paid users; `due` is the scheduled slot"""
+    job_key = job_key or f"lesson_notifications:{due or scheduler.now():%Y-%m-%d %H}"
+    users = db.iter_users_for_notification()
+
+    async def send(user):
+        message = "🔔 Bugun soat 18:00 da ESL darsi bo'lib o'tadi! Zoom linkni tekshiring!"
+        if user['language'] == 'ru':
+            message = "🔔 Сегодня в 18:00 урок ESL! Проверьте ссылку Zoom!"
+        elif user['language'] == 'en':
+            message = "🔔 Today at 18:00 ESL lesson! Check the Zoom link!"
+
+        await bot.send_message(user['telegram_id'], message)
+
+    return await broadcaster.run(users, send, name='lesson_notifications', job_key=job_key)
+
+
+def register_notification_jobs(bot):
+    """Schedule notifications for 12 and 6 hours before the 18:00 lesson"""
+    scheduler.add_job('lesson_reminder_12h', '0 6 * * *', lambda due: send_lesson_notifications(bot, due=due))
+    scheduler.add_job('lesson_reminder_6h', '0 12 * * *', lambda due: send_lesson_notifications(bot, due=due))
+    # Pick up admin panel broadcasts; a slot is skipped while the previous run is still sending
+    scheduler.add_job('queued_broadcasts', '* * * * *', lambda due: run_queued_broadcasts(bot), catch_up='skip')
+
+
+async def send_subscription_to_all(bot, job_key=None):
+    job_key = job_key or f"subscription_to_all:{scheduler.now():%Y-%m-%d}"
+    users = db.iter_all_users()
+
+    async def send(user):
+        lang = user['language'] if user['language'] in TEXTS else 'uz'
+        await bot.send_message(
+            user['telegram_id'],
+            TEXTS[lang]['subscription_required'],
+            reply_markup=continue_keyboard(lang)
+        )
+
+    return await broadcaster.run(users, send, name='subscription_to_all', job_key=job_key)
+
+
+async def send_subscription_to_unsubscribed(bot, job_key=None):
+    job_key = job_key or f"subscription_to_unsubscribed:{scheduler.now():%Y-%m-%d}"
+    users = db.iter_users_not_in_channel(CHANNEL_MEMBERSHIP_TTL)
+
+    async def send(user):
+        # Only unknown or stale entries reach the Bot API here; that call needs
+        # its own token on top of the one the broadcaster takes for the send
+        if await is_channel_member(bot, user['telegram_id'], before_call=bucket.acquire):
+            return False
+        lang = user['language'] if user['language'] in TEXTS else 'uz'
+        await bot.send_message(
+            user['telegram_id'],
+            TEXTS[lang]['subscription_required'],
+            reply_markup=subscription_keyboard(lang)
+        )
+
+    return await broadcaster.run(users, send, name='subscription_to_unsubscribed', job_key=job_key)
+
+
+async def send_to_segment(bot, segment, texts, job_key):
+    """Send a marketing message to a segments.Segment; `texts` maps language -> text.
+
+    Queued from the admin panel and run on the leader by run_queued_broadcasts;
+    the segment and texts are saved with the job so an interrupted run is
+    finished by resume_broadcasts.
+    """
+    users = db.iter_segment(segment)
+
+    async def send(user):
+        text = texts.get(user['language']) or texts.get('uz')
+        if not text:
+            return False
+        await bot.send_message(user['telegram_id'], text)
+
+    params = {'segment': segment.to_params(), 'texts': texts}
+    return await broadcaster.run(users, send, name='segment', job_key=job_key, params=params)
+
+
+async def run_queued_broadcasts(bot):
+    """Send the broadcasts queued by the admin panel, one after another.
+
+    Only the leader sends, so queued jobs share the process's token bucket
+    with the scheduled broadcasts and are never run by two replicas.
+    """
+    while True:
+        job = await db.claim_queued_broadcast_job()
+        if job is None:
+            return
+        logger.info(f"Starting queued broadcast {job['job_key']}")
+        await send_to_segment(bot, Segment.from_params(job['params']['segment']),
+                              job['params']['texts'], job['job_key'])
+
+
+async def resume_broadcasts(bot):
+    """Finish broadcast jobs that were interrupted by a crash or redeploy"""
+    from discount_calculator import DiscountCalculator
+
+    runners = {
+        'lesson_notifications': lambda job: send_lesson_notifications(bot, job_key=job['job_key']),
+        'subscription_to_all': lambda job: send_subscription_to_all(bot, job_key=job['job_key']),
+        'subscription_to_unsubscribed': lambda job: send_subscription_to_unsubscribed(bot, job_key=job['job_key']),
+        'monthly_discount': lambda job: DiscountCalculator.send_monthly_discount_notifications(
+            bot, job_key=job['job_key']),
+        'segment': lambda job: send_to_segment(
+            bot, Segment.from_params(job['params']['segment']), job['params']['texts'], job['job_key']),
+    }
+
+    for job in await db.get_resumable_broadcast_jobs(BROADCAST_RESUME_HOURS):
+        runner = runners.get(job['name'])
+        if runner is None:
+            logger.warning(f"No runner for interrupted broadcast {job['job_key']}")
+            continue
+        logger.info(f"Resuming interrupted broadcast {job['job_key']}")
+        await runner(job)
@@ -0,0 +1,83 @@
+"""
+Delivery of user notifications queued in the outbox table
+"""
+
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter
+from database import db
+from notifications import bucket, classify_failure, PERMANENT_FAILURES
+from config import OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxWorker:
+    """Drain the outbox in batches through the bot's session.
+
+    Rows are claimed with FOR UPDATE SKIP LOCKED and a lease, so several
+    replicas can drain the same table without sending a message twice.
+    """
+
+    METHODS = ('send_message', 'send_photo', 'send_document')
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 poll_interval=5, lease_seconds=120, base_delay=5, max_delay=3600):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._wakeup = None
+
+    def wake(self):
+        """Deliver right away instead of waiting for the next poll"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _send(self, bot, row):
+        if row['method'] not in self.METHODS:
+            raise ValueError(f"Unsupported outbox method {row['method']!r}")
+        await bucket.acquire()
+        await getattr(bot, row['method'])(row['chat_id'], **row['payload'])
+
+    async def _deliver_batch(self, bot, rows):
+        sent, failures = [], []
+        for row in rows:
+            try:
+                await self._send(bot, row)
+                sent.append(row['id'])
+            except TelegramRetryAfter as e:
+                bucket.pause(e.retry_after)
+                failures.append((row['id'], str(e), float(e.retry_after)))
+            except Exception as e:
+                attempts = row['attempts'] + 1
+                give_up = attempts >= self.max_attempts or classify_failure(e) in PERMANENT_FAILURES
+                retry_in = None if give_up else float(min(self.max_delay, self.base_delay * 2 ** attempts))
+                failures.append((row['id'], str(e), retry_in))
+                logger.warning(f"Outbox delivery {row['id']} to {row['chat_id']} failed: {e}")
+        if sent:
+            await db.mark_outbox_sent(sent)
+        if failures:
+            await db.mark_outbox_failed(failures)
+
+    async def run(self, bot):
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                rows = await db.claim_outbox_batch(self.batch_size, self.lease_seconds)
+                if rows:
+                    await self._deliver_batch(bot, rows)
+                    if len(rows) == self.batch_size:
+                        continue
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+outbox_worker = OutboxWorker()
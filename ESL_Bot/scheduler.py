@@ -0,0 +1,191 @@
+"""
+In-process scheduler for periodic jobs (lesson reminders, monthly discounts)
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from calendar import monthrange
+from config import SCHEDULER_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+
+class CronSpec:
+    """Five-field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept `*`, numbers, lists (`6,12`), ranges (`1-5`) and steps (`*/15`).
+    Day-of-month also accepts `L` for the last day of the month. Day-of-week
+    uses 0-6 with 0 = Monday. Both day fields must match when both are set.
+    """
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        self.last_day = fields[2] == 'L'
+        if self.last_day:
+            fields[2] = '*'
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        )
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field {field!r} is out of range {low}-{high}")
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def _day_matches(self, day):
+        if day.month not in self.months or day.weekday() not in self.weekdays:
+            return False
+        if self.last_day:
+            return day.day == monthrange(day.year, day.month)[1]
+        return day.day in self.days
+
+    def next_after(self, moment):
+        """Return the first matching minute strictly after `moment` (tz-aware)"""
+        start = (moment + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        day = start.date()
+        # Five years covers every valid expression, including Feb 29
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                same_day = day == start.date()
+                for hour in self.hours:
+                    if same_day and hour < start.hour:
+                        continue
+                    for minute in self.minutes:
+                        if same_day and hour == start.hour and minute < start.minute:
+                            continue
+                        return datetime(day.year, day.month, day.day, hour, minute, tzinfo=moment.tzinfo)
+            day += timedelta(days=1)
+        raise ValueError(f"Cron expression never fires: {self.expression!r}")
+
+
+class Job:
+    # What to do when the loop wakes up later than `grace` after the due time
+    # (event loop stall, process start shortly after the slot):
+    #   'run_once' - run once now, then continue with the next slot
+    #   'skip'     - drop the missed slot
+    CATCH_UP_POLICIES = ('run_once', 'skip')
+
+    def __init__(self, name, spec, func, catch_up='run_once', grace=timedelta(minutes=30)):
+        if catch_up not in self.CATCH_UP_POLICIES:
+            raise ValueError(f"Unknown catch-up policy {catch_up!r}")
+        self.name = name
+        self.spec = CronSpec(spec)
+        self.func = func
+        self.catch_up = catch_up
+        self.grace = grace
+        self.next_run = None
+        self.task = None
+
+
+class Scheduler:
+    """Keep jobs in a heap ordered by next fire time and sleep until the earliest one"""
+
+    def __init__(self, timezone=SCHEDULER_TIMEZONE):
+        self.tz = ZoneInfo(timezone)
+        self.jobs = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = None
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def add_job(self, name, spec, func, catch_up='run_once', grace=timedelta(minutes=30)):
+        """Register `func` under a cron spec; it is called with the due slot (a
+        tz-aware datetime), which is what job keys should be built from"""
+        if name in self.jobs:
+            raise ValueError(f"Job {name!r} is already registered")
+        job = Job(name, spec, func, catch_up, grace)
+        # Looking back by `grace` lets a slot missed during a restart be caught up
+        job.next_run = job.spec.next_after(self.now() - job.grace)
+        self.jobs[name] = job
+        self._push(job)
+        if self._wakeup:
+            self._wakeup.set()
+        return job
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+
+    def _fire(self, job, due):
+        lateness = self.now() - due
+        if lateness > job.grace and job.catch_up == 'skip':
+            logger.warning(f"Skipping job {job.name} due at {due}, {lateness} late")
+            return
+        if job.task and not job.task.done():
+            logger.warning(f"Job {job.name} is still running, skipping run due at {due}")
+            return
+        logger.info(f"Running job {job.name} due at {due}")
+        job.task = asyncio.create_task(self._run_job(job, due))
+
+    @staticmethod
+    async def _run_job(job, due):
+        try:
+            await job.func(due)
+        except Exception as e:
+            logger.exception(f"Job {job.name} failed: {e}")
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        # A replica may win the leader election long after add_job; only slots
+        # within `grace` of now may be caught up, older ones are history
+        self._heap = []
+        for job in self.jobs.values():
+            job.next_run = job.spec.next_after(self.now() - job.grace)
+            self._push(job)
+        try:
+            await self._loop()
+        finally:
+            # Losing leadership or shutting down also stops jobs that are mid-run
+            for job in self.jobs.values():
+                if job.task and not job.task.done():
+                    job.task.cancel()
+
+    async def _loop(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            due, _, job = self._heap[0]
+            delay = (due - self.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            heapq.heappop(self._heap)
+            self._fire(job, due)
+            # Schedule from now, not from `due`, so a long stall collapses into one catch-up run
+            job.next_run = job.spec.next_after(max(due, self.now()))
+            self._push(job)
+
+
+scheduler = Scheduler()
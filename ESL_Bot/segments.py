@@ -0,0 +1,101 @@
+"""
+Broadcast audience segments compiled to parameterized SQL over the users table
+"""
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Optional, Sequence
+from membership import MEMBER_STATUSES
+
+
+@dataclass
+class Segment:
+    """Filter over users; every field left as None matches everyone.
+
+    Only active (reachable) users are included unless `active` is set to None.
+    """
+    languages: Optional[Sequence[str]] = None
+    regions: Optional[Sequence[str]] = None
+    paid: Optional[bool] = None
+    active: Optional[bool] = True
+    min_age: Optional[int] = None
+    max_age: Optional[int] = None
+    registered_after: Optional[datetime] = None
+    registered_before: Optional[datetime] = None
+    min_referrals: Optional[int] = None
+    max_referrals: Optional[int] = None
+    channel_member: Optional[bool] = None
+
+    DATETIME_FIELDS = ('registered_after', 'registered_before')
+
+    def to_params(self):
+        """JSON-safe dict, stored with a broadcast job so it can be resumed"""
+        params = asdict(self)
+        for name in self.DATETIME_FIELDS:
+            if params[name] is not None:
+                params[name] = params[name].isoformat()
+        for name in ('languages', 'regions'):
+            if params[name] is not None:
+                params[name] = list(params[name])
+        return params
+
+    @classmethod
+    def from_params(cls, params):
+        params = dict(params)
+        for name in cls.DATETIME_FIELDS:
+            if params.get(name) is not None:
+                params[name] = datetime.fromisoformat(params[name])
+        return cls(**params)
+
+    def where(self, first_param=1):
+        """Return (conditions, args) with placeholders numbered from `first_param`"""
+        conditions, args = [], []
+
+        def param(value):
+            args.append(value)
+            return f"${first_param + len(args) - 1}"
+
+        if self.active is not None:
+            conditions.append(f"u.is_active = {param(self.active)}")
+        if self.paid is not None:
+            conditions.append(f"u.payment_status = {param(self.paid)}")
+        if self.languages:
+            conditions.append(f"u.language = ANY({param(list(self.languages))}::text[])")
+        if self.regions:
+            conditions.append(f"u.region = ANY({param(list(self.regions))}::text[])")
+        if self.min_age is not None:
+            conditions.append(f"u.age >= {param(self.min_age)}")
+        if self.max_age is not None:
+            conditions.append(f"u.age <= {param(self.max_age)}")
+        if self.registered_after is not None:
+            conditions.append(f"u.created_at >= {param(self.registered_after)}")
+        if self.registered_before is not None:
+            conditions.append(f"u.created_at < {param(self.registered_before)}")
+        if self.min_referrals is not None:
+            conditions.append(f"u.referral_count >= {param(self.min_referrals)}")
+        if self.max_referrals is not None:
+            conditions.append(f"u.referral_count <= {param(self.max_referrals)}")
+        if self.channel_member is True:
+            conditions.append(f"m.status = ANY({param(list(MEMBER_STATUSES))}::text[])")
+        elif self.channel_member is False:
+            conditions.append(f"(m.telegram_id IS NULL OR m.status <> ALL({param(list(MEMBER_STATUSES))}::text[]))")
+        return conditions, args
+
+    @property
+    def _from(self):
+        if self.channel_member is None:
+            return "users u"
+        return "users u LEFT JOIN channel_members m ON m.telegram_id = u.telegram_id"
+
+    def keyset_query(self, columns="u.telegram_id, u.language"):
+        """Query for Database._iter_keyset: $1 is the last telegram_id, $2 the page size"""
+        conditions, args = self.where(first_param=3)
+        conditions.append("u.telegram_id > $1")
+        query = (f"SELECT {columns} FROM {self._from} WHERE {' AND '.join(conditions)} "
+                 f"ORDER BY u.telegram_id LIMIT $2")
+        return query, args
+
+    def count_query(self):
+        conditions, args = self.where()
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return f"SELECT COUNT(*) FROM {self._from}{where}", args
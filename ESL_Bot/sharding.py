@@ -0,0 +1,167 @@
+"""
+Sharded mode: one receiver process fans updates out to worker processes by user id
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import secrets
+import aiohttp
+from aiohttp import web
+from config import SHARD_QUEUE_SIZE, WEBHOOK_SECRET
+
+logger = logging.getLogger(__name__)
+
+# Updates taken from the inter-process queue per executor round trip
+QUEUE_BATCH = 100
+
+
+def update_user_id(update):
+    """Partition key of a raw update: the sender, else the chat, else 0"""
+    for field, event in update.items():
+        if field == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+        chat = event.get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+class ShardedReceiver:
+    """Receive raw updates and route each user to a fixed worker process.
+
+    The receiver only decodes JSON and picks a queue, so the parsing, filters
+    and handlers run on `workers` cores. All updates of one user go through
+    the same queue and reach that worker's dispatcher in order (`run_worker`).
+    Workers are separate interpreters (spawn), each with its own Dispatcher,
+    asyncpg pool and bot session.
+    """
+
+    def __init__(self, workers, queue_size=SHARD_QUEUE_SIZE):
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = []
+
+    def start(self):
+        for index, updates in enumerate(self.queues):
+            process = self.context.Process(target=run_worker, args=(index, updates),
+                                           name=f"bot-worker-{index}", daemon=True)
+            process.start()
+            self.processes.append(process)
+        logger.info(f"Started {len(self.processes)} worker processes")
+
+    def alive(self):
+        return all(process.is_alive() for process in self.processes)
+
+    def dispatch(self, update):
+        """Queue an update for its user's worker; False if that worker is backed up"""
+        updates = self.queues[update_user_id(update) % len(self.queues)]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    async def handle_webhook(self, request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401, text="Unauthorized")
+        # Telegram retries a non-2xx delivery later, which is the backpressure we want
+        if not self.dispatch(await request.json()):
+            return web.Response(status=503, text="Busy")
+        return web.Response()
+
+    async def poll(self, bot, allowed_updates, timeout=30):
+        """Long-poll getUpdates without building Update objects"""
+        url = bot.session.api.api_url(token=bot.token, method='getUpdates')
+        offset = None
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout + 10)) as session:
+            while True:
+                params = {'timeout': timeout, 'allowed_updates': allowed_updates}
+                if offset is not None:
+                    params['offset'] = offset
+                try:
+                    async with session.post(url, json=params) as response:
+                        payload = await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.error(f"getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not payload.get('ok'):
+                    logger.error(f"getUpdates error: {payload.get('description')}")
+                    await asyncio.sleep(payload.get('parameters', {}).get('retry_after', 5))
+                    continue
+
+                for update in payload['result']:
+                    while not self.dispatch(update):
+                        await asyncio.sleep(0.1)
+                    offset = update['update_id'] + 1
+
+    def stop(self, timeout=10):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+def run_worker(index, updates):
+    """Entry point of a worker process"""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_worker(index, updates))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker(index, updates):
+    # Imported here so every worker builds its own bot, dispatcher and pool
+    import main
+    from database import db
+
+    await main.startup()
+    loop = asyncio.get_running_loop()
+    # Updates are started in arrival order; the dispatcher's ChatEventIsolation
+    # runs each chat's updates one by one and caps how many run at once.
+    # This only bounds how many a worker holds in memory when it falls behind
+    backlog = asyncio.Semaphore(SHARD_QUEUE_SIZE)
+    tasks = set()
+
+    async def process(update):
+        try:
+            await main.dp.feed_raw_update(main.bot, update)
+        except Exception as e:
+            logger.exception(f"Worker {index} failed to handle update {update.get('update_id')}: {e}")
+        finally:
+            backlog.release()
+
+    def take():
+        batch = [updates.get()]
+        while len(batch) < QUEUE_BATCH:
+            try:
+                batch.append(updates.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    logger.info(f"Worker {index} is handling updates")
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, take)
+            for update in batch:
+                if update is None:
+                    return
+                await backlog.acquire()
+                task = asyncio.create_task(process(update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await main.stop_background_tasks()
+        await main.bot.session.close()
+        await db.close_pool()
@@ -0,0 +1,80 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import pytest
+from scheduler import CronSpec
+
+TZ = ZoneInfo('Asia/Tashkent')
+
+
+def at(*args):
+    return datetime(*args, tzinfo=TZ)
+
+
+def test_parses_lists_ranges_and_steps():
+    spec = CronSpec('*/15 6,12 1-3 * *')
+    assert spec.minutes == [0, 15, 30, 45]
+    assert spec.hours == [6, 12]
+    assert spec.days == [1, 2, 3]
+    assert spec.months == list(range(1, 13))
+    assert spec.weekdays == list(range(7))
+
+
+@pytest.mark.parametrize('expression', ['0 6 * *', '60 * * * *', '0 24 * * *', '0 0 0 * *', '0 0 * * 7'])
+def test_rejects_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSpec(expression)
+
+
+def test_next_after_is_strictly_after():
+    spec = CronSpec('0 6 * * *')
+    assert spec.next_after(at(2026, 10, 18, 5, 59)) == at(2026, 10, 18, 6, 0)
+    assert spec.next_after(at(2026, 10, 18, 6, 0)) == at(2026, 10, 19, 6, 0)
+    assert spec.next_after(at(2026, 10, 18, 6, 0, 30)) == at(2026, 10, 19, 6, 0)
+
+
+def test_next_after_keeps_the_timezone():
+    assert CronSpec('* * * * *').next_after(at(2026, 10, 18, 23, 59)).tzinfo is TZ
+
+
+def test_next_after_rolls_over_the_year():
+    assert CronSpec('0 0 1 1 *').next_after(at(2026, 10, 18, 12, 0)) == at(2027, 1, 1, 0, 0)
+
+
+def test_steps_within_the_hour():
+    spec = CronSpec('*/15 * * * *')
+    assert spec.next_after(at(2026, 10, 18, 10, 7)) == at(2026, 10, 18, 10, 15)
+    assert spec.next_after(at(2026, 10, 18, 10, 45)) == at(2026, 10, 18, 11, 0)
+
+
+def test_weekday_zero_is_monday():
+    # 2026-10-18 is a Sunday
+    assert CronSpec('0 10 * * 0').next_after(at(2026, 10, 18, 12, 0)) == at(2026, 10, 19, 10, 0)
+    assert CronSpec('0 10 * * 6').next_after(at(2026, 10, 18, 9, 0)) == at(2026, 10, 18, 10, 0)
+
+
+def test_both_day_fields_must_match():
+    # Friday (4) the 13th: the next one after 2026-10-18 is 2026-11-13
+    assert CronSpec('0 0 13 * 4').next_after(at(2026, 10, 18, 0, 0)) == at(2026, 11, 13, 0, 0)
+
+
+@pytest.mark.parametrize('moment, expected', [
+    (at(2026, 2, 10, 0, 0), at(2026, 2, 28, 9, 0)),
+    (at(2028, 2, 10, 0, 0), at(2028, 2, 29, 9, 0)),
+    (at(2026, 1, 31, 9, 0), at(2026, 2, 28, 9, 0)),
+    (at(2026, 4, 29, 12, 0), at(2026, 4, 30, 9, 0)),
+    (at(2026, 12, 31, 9, 30), at(2027, 1, 31, 9, 0)),
+])
+def test_last_day_of_month(moment, expected):
+    assert CronSpec('0 9 L * *').next_after(moment) == expected
+
+
+def test_last_day_combined_with_weekday():
+    # Last day of the month that is also a Saturday (5): 2026-10-31, then 2027-07-31
+    spec = CronSpec('0 9 L * 5')
+    assert spec.next_after(at(2026, 10, 18, 0, 0)) == at(2026, 10, 31, 9, 0)
+    assert spec.next_after(at(2026, 10, 31, 9, 0)) == at(2027, 7, 31, 9, 0)
+
+
+def test_expression_that_never_fires():
+    with pytest.raises(ValueError):
+        CronSpec('0 0 31 2 *').next_after(at(2026, 1, 1, 0, 0))
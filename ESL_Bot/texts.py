@@ -39,7 +39,8 @@ TEXTS = {
         ],
         'subscription_required': "Iltimos, quyidagi kanalga obuna bo'ling: \n@ESL_Proficiency\nObuna bo'lgach, 'Davom etish' tugmasini bosing.",
         'continue': "Davom etish",
-        'subscribe': "Obuna bo'lish"
+        'subscribe': "Obuna bo'lish",
+        'not_subscribed': "Siz hali @ESL_Proficiency kanaliga obuna bo'lmagansiz. Obuna bo'lib, qaytadan urinib ko'ring."
     },
     'ru': {
         'choose_language': "🇺🇿 Tilni tanlang / 🇷🇺 Выберите язык / 🇬🇧 Choose language",
@@ -81,7 +82,8 @@ TEXTS = {
         ],
         'subscription_required': "Пожалуйста, подпишитесь на канал: \n@ESL_Proficiency\nПосле подписки нажмите 'Продолжить'.",
         'continue': "Продолжить",
-        'subscribe': "Подписаться"
+        'subscribe': "Подписаться",
+        'not_subscribed': "Вы еще не подписаны на канал @ESL_Proficiency. Подпишитесь и попробуйте снова."
     },
     'en': {
         'choose_language': "🇺🇿 Tilni tanlang / 🇷🇺 Выберите язык / 🇬🇧 Choose language",
@@ -123,6 +125,33 @@ TEXTS = {
         ],
         'subscription_required': "Please subscribe to the following channel: \n@ESL_Proficiency\nAfter subscribing, press 'Continue'.",
         'continue': "Continue",
-        'subscribe': "Subscribe"
+        'subscribe': "Subscribe",
+        'not_subscribed': "You are not subscribed to @ESL_Proficiency yet. Please subscribe and try again."
     }
 }
+
+
+# Reply-keyboard buttons that route to a handler
+MENU_ACTIONS = (
+    'main_menu', 'payment', 'questions', 'faq', 'ask_question', 'settings', 'referral',
+    'change_age', 'change_name', 'change_number', 'change_city', 'change_language'
+)
+
+
+def _build_button_index():
+    """Map every localized button label to (action, language).
+
+    Labels shared by several languages (e.g. "📋 FAQ") map to a None language.
+    """
+    index = {}
+    for lang, texts in TEXTS.items():
+        for action in MENU_ACTIONS:
+            label = texts[action]
+            if label in index and index[label][1] != lang:
+                index[label] = (action, None)
+            else:
+                index[label] = (action, lang)
+    return index
+
+
+BUTTON_INDEX = _build_button_index()